@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# benchmark.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Time the scanning, decoding and startup paths of the activity.
+
+    python benchmark.py [--sizes 1000,10000,100000] [--output FILE]
+
+Synthetic trees are generated under a work directory (kept with
+--work-dir so the larger ones are only made once): images and other
+files in equal-sized directories, some of them hidden, some of them
+Cache directories below a hidden one, and some images without an
+extension so their type has to be sniffed. The Journal is replaced by
+an in-memory stand-in for sugar3.datastore whose entries carry
+previews of a configurable size.
+
+Each step is timed on its own: ScanIndex.rescan, the walk behind
+load_files, with an empty and an up to date scan index,
+load_journal_table up to its first page, the search index of the
+whole Journal filled after it, the whole of journal_pages, thumbnail
+and preview decoding, and build_canvas (the window short of the sugar
+frame, which needs a display). Results are written as JSON to
+bench_output.txt so runs can be compared across commits.
+
+Startup is timed as import_activity, a fresh interpreter importing the
+activity module, then build_canvas and first_paint, up to the first
+frame of the window. Their sum is checked against --startup-budget,
+and the run fails when it is over.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import base64
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+BUNDLE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(BUNDLE_DIR, 'bench_output.txt')
+
+# files per generated directory
+DIR_SIZE = 100
+# one directory in HIDDEN_EVERY is hidden, one in CACHE_EVERY is a
+# Cache directory below a hidden one
+HIDDEN_EVERY = 10
+CACHE_EVERY = 25
+# out of every 10 files, IMAGE_SHARE are images
+IMAGE_SHARE = 7
+# one image in SNIFF_EVERY has no extension
+SNIFF_EVERY = 20
+IMAGE_SIZE = (1024, 768)
+# seconds from starting the interpreter to the first frame on an XO-1
+STARTUP_BUDGET = 3.0
+
+
+class FakeSignal(object):
+
+    def __init__(self):
+
+        self._callbacks = []
+
+    def connect(self, callback, *args):
+
+        self._callbacks.append((callback, args))
+
+    def send(self, sender, **kwargs):
+
+        for callback, args in self._callbacks:
+            callback(sender, *args, **kwargs)
+
+
+class FakeDSObject(object):
+
+    def __init__(self, metadata, file_path = None):
+
+        self.metadata = metadata
+        self.object_id = metadata.get('uid')
+        self._file_path = file_path
+
+    def get_file_path(self, fetch = True):
+
+        return self._file_path
+
+    def destroy(self):
+        pass
+
+
+class FakeDatastore(object):
+    """In-memory stand-in for sugar3.datastore.datastore.
+
+    entries are metadata dicts, newest first; find honours limit,
+    offset and properties, which is all the activity asks of it."""
+
+    def __init__(self, entries, file_path = None):
+
+        self.entries = entries
+        self.file_path = file_path
+        self.created = FakeSignal()
+        self.updated = FakeSignal()
+        self.deleted = FakeSignal()
+
+    def find(self, query, sorting = None, limit = None, offset = 0,
+        properties = None):
+
+        if limit is None:
+            entries = self.entries[offset:]
+        else:
+            entries = self.entries[offset:offset + limit]
+        ds_objects = []
+        for metadata in entries:
+            if properties:
+                metadata = dict((name, metadata.get(name))
+                    for name in properties)
+            else:
+                metadata = dict(metadata)
+            ds_objects.append(FakeDSObject(metadata, self.file_path))
+        return ds_objects, len(self.entries)
+
+    def get(self, object_id):
+
+        for metadata in self.entries:
+            if metadata['uid'] == object_id:
+                return FakeDSObject(dict(metadata), self.file_path)
+        raise ValueError(object_id)
+
+    def delete(self, object_id):
+
+        self.entries = [metadata for metadata in self.entries
+            if metadata['uid'] != object_id]
+        self.deleted.send(None, object_id = object_id)
+
+    def install(self):
+        """Make this the sugar3.datastore.datastore module; must run
+        before the activity is imported"""
+
+        module = types.ModuleType('sugar3.datastore.datastore')
+        for name in ['find', 'get', 'delete', 'created', 'updated',
+            'deleted']:
+            setattr(module, name, getattr(self, name))
+        package = types.ModuleType('sugar3.datastore')
+        package.datastore = module
+        sys.modules['sugar3.datastore'] = package
+        sys.modules['sugar3.datastore.datastore'] = module
+
+
+def make_image(image_format, width, height):
+
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+        width, height)
+    pixbuf.fill(0x336699ff)
+    return pixbuf.save_to_bufferv(image_format, [], [])[1]
+
+
+def make_journal(count, preview_size, preview_share, encoding):
+    """Return count Journal entries, preview_share of them with a
+    preview of preview_size pixels"""
+
+    preview = make_image('png', *preview_size)
+    if encoding == 'base64':
+        preview = base64.b64encode(preview)
+
+    entries = []
+    for n in range(count):
+        entries.append({
+            'uid': 'uid-%08d' % n,
+            'title': 'Entry %d' % n,
+            'timestamp': str(2000000000 - n),
+            'mime_type': 'image/png',
+            'description': 'Synthetic entry %d' % n,
+            'preview': preview if n % 100 < preview_share * 100 else '',
+            })
+    return entries
+
+
+def make_tree(root, count):
+    """Fill root with count files laid out as described above"""
+
+    if os.path.isdir(root):
+        return
+    tmp_root = root + '.tmp'
+    if os.path.isdir(tmp_root):
+        shutil.rmtree(tmp_root)
+
+    jpeg = make_image('jpeg', *IMAGE_SIZE)
+    png = make_image('png', *IMAGE_SIZE)
+    for n in range(count):
+        directory_number = n // DIR_SIZE
+        if directory_number % CACHE_EVERY == CACHE_EVERY - 1:
+            directory = os.path.join(tmp_root, '.cache%d' % directory_number,
+                'Cache')
+        elif directory_number % HIDDEN_EVERY == HIDDEN_EVERY - 1:
+            directory = os.path.join(tmp_root, '.hidden%d' % directory_number)
+        else:
+            directory = os.path.join(tmp_root, 'dir%d' % (directory_number %
+                10), 'photos%d' % directory_number)
+        if n % DIR_SIZE == 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if n % 10 >= IMAGE_SHARE:
+            name, data = 'notes%d%s' % (n, ['.txt', '.odt', ''][n % 3]), \
+                'not an image\n' * 16
+        elif n % SNIFF_EVERY == 0:
+            name, data = 'image%d' % n, png
+        elif n % 2:
+            name, data = 'image%d.jpg' % n, jpeg
+        else:
+            name, data = 'image%d.png' % n, png
+
+        f = open(os.path.join(directory, name), 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    os.rename(tmp_root, root)
+
+
+def list_images(root, limit):
+
+    images = []
+    for directory, subdirs, files in os.walk(root):
+        for name in files:
+            if name.startswith('image'):
+                images.append(os.path.join(directory, name))
+                if len(images) >= limit:
+                    return images
+    return images
+
+
+def measure(results, name, func, items = None, **details):
+    """Run func, record how long it took and return its result"""
+
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+    if items is None:
+        items = result
+    record = {'name': name, 'seconds': round(seconds, 4), 'items': items}
+    if items and seconds:
+        record['per_second'] = round(items / seconds, 1)
+    record.update(details)
+    results.append(record)
+
+    sys.stdout.write('%-22s %10.3fs %8s items %s\n' % (name, seconds,
+        items, ' '.join('%s=%s' % item for item in sorted(details.items()))))
+    sys.stdout.flush()
+    return result
+
+
+def run_main_loop(condition, timeout = 600):
+
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        context.iteration(True)
+
+
+def get_commit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd = BUNDLE_DIR).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def import_activity():
+    """Import the activity module in a fresh interpreter"""
+
+    subprocess.check_call([sys.executable, '-c', 'import imagethumbnail'],
+        cwd = BUNDLE_DIR)
+    return 1
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the Image '
+        'Thumbnail activity on synthetic data.')
+    parser.add_argument('--sizes', default = '1000,10000,100000',
+        help = 'files in the generated trees (default %(default)s)')
+    parser.add_argument('--work-dir', default = None,
+        help = 'where trees are generated and kept, a temporary '
+        'directory by default')
+    parser.add_argument('--journal-entries', type = int, default = 1000)
+    parser.add_argument('--preview-size', default = '300x225',
+        help = 'pixels of the Journal previews (default %(default)s)')
+    parser.add_argument('--preview-share', type = float, default = 0.9,
+        help = 'share of the Journal entries with a preview')
+    parser.add_argument('--preview-encoding', choices = ['raw', 'base64'],
+        default = 'raw')
+    parser.add_argument('--decode-count', type = int, default = 200,
+        help = 'images decoded by the decode steps')
+    parser.add_argument('--no-window', action = 'store_true',
+        help = 'skip the steps that need a display')
+    parser.add_argument('--startup-budget', type = float,
+        default = STARTUP_BUDGET, help = 'seconds allowed from the import '
+        'of the activity to its first frame (default %(default)s)')
+    parser.add_argument('--output', default = DEFAULT_OUTPUT)
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    preview_size = tuple(int(n) for n in args.preview_size.split('x'))
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'imagethumbnail-')
+    activity_root = os.path.join(work_dir, 'activity-root')
+    os.environ['SUGAR_ACTIVITY_ROOT'] = activity_root
+    # the exclusion lists are read relative to the bundle
+    os.chdir(BUNDLE_DIR)
+
+    datastore = FakeDatastore(make_journal(args.journal_entries,
+        preview_size, args.preview_share, args.preview_encoding))
+    datastore.install()
+
+    from gi.repository import Gtk
+    import imagethumbnail
+    from imagethumbnail import ImageThumbnail
+    from decoder import decode_preview
+    from decoder import load_scaled
+    from scanindex import ScanIndex
+    from scanner import get_scan_rules
+
+    imagethumbnail.prefetch_tabs = False
+    results = []
+    measure(results, 'import_activity', import_activity)
+
+    if args.no_window:
+        bench = None
+    else:
+        def build():
+            bench = ImageThumbnail.__new__(ImageThumbnail)
+            Gtk.Window.__init__(bench)
+            bench.build_canvas()
+            return bench
+        bench = measure(results, 'build_canvas', build, 1)
+
+        def first_paint():
+            painted = []
+            bench.canvas.connect('draw',
+                lambda widget, cr: painted.append(widget))
+            bench.add(bench.canvas)
+            bench.show_all()
+            run_main_loop(lambda: painted, 60)
+            bench.hide()
+            return len(painted[:1])
+        measure(results, 'first_paint', first_paint)
+
+        # what _start_cb does after the first frame
+        measure(results, 'open_indexes', lambda: bench.open_indexes() or 1)
+
+        def journal_first_page():
+            bench.load_journal_table(0)
+            run_main_loop(lambda: bench.rows[0] or bench.pages[0] is None)
+            return bench.ls_journal[0].iter_n_children(None)
+        measure(results, 'journal_first_page', journal_first_page,
+            entries = args.journal_entries)
+
+        def journal_index():
+            run_main_loop(lambda: bench.scan_id[0] is None)
+            return len(bench.search[0])
+        measure(results, 'journal_index', journal_index,
+            entries = args.journal_entries)
+
+        def journal_all_pages():
+            bench.ls_journal[0].clear()
+            bench.rows[0].clear()
+            for rows in bench.journal_pages(0):
+                for row in rows:
+                    bench.add_row(0, row)
+            return bench.ls_journal[0].iter_n_children(None)
+        measure(results, 'journal_all_pages', journal_all_pages,
+            entries = args.journal_entries)
+
+    previews = [entry['preview'] for entry in datastore.entries
+        if entry['preview']][:args.decode_count]
+    measure(results, 'decode_preview', lambda: len([decode_preview(preview)
+        for preview in previews]), preview_size = args.preview_size)
+
+    from thumbcache import ThumbnailCache
+    for size in sizes:
+        root = os.path.join(work_dir, 'tree-%d' % size)
+        measure(results, 'make_tree', lambda: make_tree(root, size) or size,
+            files = size)
+
+        index_file = os.path.join(work_dir, 'scan-index-%d.db' % size)
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        # the walk load_files runs, with the rules of a mounted volume
+        for step in ['rescan_cold', 'rescan_warm']:
+            scan_index = ScanIndex(index_file)
+            measure(results, step, lambda: sum(len(added)
+                for path, added, removed in scan_index.rescan(root,
+                get_scan_rules(root))), files = size)
+            scan_index.close()
+
+        images = list_images(root, args.decode_count)
+        measure(results, 'decode_thumbnail', lambda: len([load_scaled(path,
+            320, 240) for path in images]), files = size)
+
+        cache = ThumbnailCache(os.path.join(work_dir, 'thumbnails-%d' % size),
+            320, 240, 1024 * 1024 * 1024)
+        for step in ['thumbnail_cache_miss', 'thumbnail_cache_hit']:
+            measure(results, step, lambda: len([cache.get_thumbnail(path)
+                for path in images]), files = size)
+
+    if bench is not None:
+        bench.decode_pool.stop()
+        bench.delete_pool.stop()
+        bench.hash_pool.stop()
+        bench.scan_index.close()
+
+    startup = sum(record['seconds'] for record in results
+        if record['name'] in ['import_activity', 'build_canvas',
+        'first_paint'])
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+        'startup': {'seconds': round(startup, 4),
+            'budget': args.startup_budget},
+        }
+    f = open(args.output, 'w')
+    try:
+        json.dump(report, f, indent = 1, sort_keys = True)
+    finally:
+        f.close()
+    sys.stdout.write('Results written to %s\n' % args.output)
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    sys.stdout.write('Startup took %.3fs, the budget is %.3fs\n' % (startup,
+        args.startup_budget))
+    if startup > args.startup_budget:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# decoder.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Background thumbnail decoding.
+
+Decoding runs in a pool of worker threads. Finished pixbufs are handed
+back to the GTK main loop from a single idle handler, a batch at a
+time, so widgets are only ever touched from the main thread.
+
+Files are decoded through load_scaled, which feeds a PixbufLoader in
+chunks and asks for the target size as soon as the header is read, so
+JPEGs are scaled down by the codec while decoding. Formats that can
+only be decoded at full resolution are refused past a pixel ceiling.
+"""
+
+import time
+import base64
+import logging
+import threading
+import multiprocessing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from gi.repository import GLib
+from gi.repository import GObject
+from gi.repository import GdkPixbuf
+
+import stats
+
+_logger = logging.getLogger('image-thumbnail')
+
+GObject.threads_init()
+
+BATCH_SIZE = 16
+# bytes fed to the PixbufLoader at a time
+CHUNK_SIZE = 64 * 1024
+# largest image decoded at full resolution, 4 bytes per pixel: 16 MB
+# a decode, times the decode threads running at once
+MAX_PIXELS = 4 * 1024 * 1024
+# formats whose loader honours the requested size while decoding
+SCALING_FORMATS = ['jpeg']
+
+
+def get_default_workers():
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def _size_prepared_cb(loader, src_width, src_height, state):
+
+    width, height, max_pixels = state['size']
+    image_format = loader.get_format()
+    if image_format is None or \
+        image_format.get_name() not in SCALING_FORMATS:
+        if src_width * src_height > max_pixels:
+            # a size of 0 makes the loader stop before it allocates the
+            # full resolution pixbuf
+            state['too_large'] = True
+            loader.set_size(0, 0)
+            return
+
+    scale = min(float(width) / src_width, float(height) / src_height, 1.0)
+    loader.set_size(max(1, int(src_width * scale)),
+        max(1, int(src_height * scale)))
+
+
+def load_scaled(filename, width, height, max_pixels = MAX_PIXELS):
+    """Return filename decoded to fit in width x height.
+
+    Raises ImageTooLarge for images over max_pixels whose format cannot
+    be scaled while decoding."""
+
+    start = time.time()
+    state = {'size': (width, height, max_pixels), 'too_large': False}
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect('size-prepared', _size_prepared_cb, state)
+
+    f = open(filename, 'rb')
+    try:
+        while not state['too_large']:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            try:
+                loader.write(data)
+            except GLib.GError:
+                if not state['too_large']:
+                    raise
+    finally:
+        f.close()
+        try:
+            loader.close()
+        except GLib.GError:
+            if not state['too_large']:
+                raise
+
+    if state['too_large']:
+        stats.count('images_too_large')
+        raise ImageTooLarge(filename)
+    stats.add_time('load_scaled', time.time() - start)
+    stats.count('images_decoded')
+    return loader.get_pixbuf()
+
+
+def decode_preview(preview):
+    """Return a pixbuf for the preview stored in Journal metadata"""
+
+    if preview[1:4] == 'PNG':
+        preview_data = preview
+    else:
+        preview_data = base64.b64decode(preview)
+
+    with stats.span('decode_preview'):
+        loader = GdkPixbuf.PixbufLoader()
+        loader.write(preview_data)
+        loader.close()
+    stats.count('previews_decoded')
+    return loader.get_pixbuf()
+
+
+class DecodePool(object):
+    """Run decode jobs on worker threads and deliver the results on the
+    main loop.
+
+    A job is a callable and its arguments; its return value (or None if
+    it raised) is passed to callback(pixbuf, *user_data) on the main
+    thread.
+    """
+
+    def __init__(self, workers = None, batch_size = BATCH_SIZE):
+
+        if not workers:
+            workers = get_default_workers()
+
+        self.batch_size = batch_size
+        self._jobs = queue.Queue()
+        self._results = []
+        self._lock = threading.Lock()
+        self._idle_id = None
+        self._stopped = False
+        self._threads = []
+
+        for n in range(workers):
+            thread = threading.Thread(target = self._run,
+                name = 'thumbnail-decode-%d' % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, args, callback, *user_data):
+
+        if not self._stopped:
+            self._jobs.put((func, args, callback, user_data))
+
+    def stop(self):
+        """Drop pending jobs and let the workers exit"""
+
+        self._stopped = True
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in self._threads:
+            self._jobs.put(None)
+
+        with self._lock:
+            del self._results[:]
+            if self._idle_id is not None:
+                GLib.source_remove(self._idle_id)
+                self._idle_id = None
+
+    def _run(self):
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            func, args, callback, user_data = job
+            try:
+                result = func(*args)
+            except Exception:
+                _logger.debug('Failed to decode %r', args, exc_info = True)
+                stats.count('decode_failures')
+                result = None
+
+            with self._lock:
+                if self._stopped:
+                    return
+                self._results.append((callback, result, user_data))
+                if self._idle_id is None:
+                    self._idle_id = GLib.idle_add(self._flush)
+
+    def _flush(self):
+
+        with self._lock:
+            batch = self._results[:self.batch_size]
+            del self._results[:self.batch_size]
+            more = bool(self._results)
+            if not more:
+                self._idle_id = None
+
+        for callback, result, user_data in batch:
+            # a failing callback must not end the idle source while
+            # _idle_id says it is still there
+            try:
+                callback(result, *user_data)
+            except Exception:
+                _logger.exception('Result callback failed')
+        return more
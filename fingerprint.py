@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# fingerprint.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Content fingerprints, to find the copies of an image.
+
+The partial fingerprint hashes the size and the first and last blocks
+of a file, which is cheap and tells nearly every two images apart.
+Files sharing a partial fingerprint are told apart by the full one,
+the hash of their whole content. For files no bigger than two blocks
+both are the hash of the whole content.
+"""
+
+import os
+import hashlib
+
+import stats
+
+# bytes hashed at each end of a file for the partial fingerprint
+BLOCK_SIZE = 64 * 1024
+
+
+def _hash_file(f):
+
+    digest = hashlib.sha1()
+    while True:
+        data = f.read(BLOCK_SIZE)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path, full = False):
+    """Return (mtime, size, partial, full) for path, full being None
+    unless asked for or covered by the partial fingerprint"""
+
+    st = os.stat(path)
+    f = open(path, 'rb')
+    try:
+        if st.st_size <= 2 * BLOCK_SIZE:
+            with stats.span('fingerprint_full'):
+                content = _hash_file(f)
+            return st.st_mtime, st.st_size, content, content
+
+        with stats.span('fingerprint_partial'):
+            digest = hashlib.sha1(str(st.st_size).encode('ascii'))
+            digest.update(f.read(BLOCK_SIZE))
+            f.seek(-BLOCK_SIZE, os.SEEK_END)
+            digest.update(f.read(BLOCK_SIZE))
+            partial = digest.hexdigest()
+        if not full:
+            return st.st_mtime, st.st_size, partial, None
+
+        f.seek(0)
+        with stats.span('fingerprint_full'):
+            content = _hash_file(f)
+        return st.st_mtime, st.st_size, partial, content
+    finally:
+        f.close()
@@ -19,53 +19,130 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-import sys
 import logging
-import zipfile
 import time
-import traceback
-from subprocess import Popen, PIPE
+import heapq
+from collections import Mapping
+from collections import OrderedDict
 
-import gi
 from gi.repository import Gtk
-from gi.repository import Gdk
 from gi.repository import GObject
-from gi.repository import Pango
+from gi.repository import GLib
 from gi.repository import GdkPixbuf
-from gi.repository import Gio
 
-from sugar3 import mime
+from sugar3 import env
 from sugar3.activity import activity
 from sugar3.datastore import datastore
 from sugar3.graphics import style
+from sugar3.graphics import iconentry
 from sugar3.graphics.toolbarbox import ToolbarBox
-from sugar3.activity.widgets import ActivityButton
 from sugar3.activity.widgets import TitleEntry
 from sugar3.activity.widgets import StopButton
 
 from gettext import gettext as _
 
+import stats
+from thumbcache import ThumbnailCache
+from thumbcache import PixbufBudget
+from decoder import DecodePool
+from decoder import decode_preview
+from decoder import load_scaled
+from scanner import HOME
+from scanner import get_journal_file
+from scanner import get_journal_path
+from scanner import get_mounts
+from scanner import get_read_only_roots
+from scanner import get_scan_rules
+
 COLUMN_TITLE = 0
 COLUMN_JOBJECT = 3
 COLUMN_IMAGE = 0
-COLUMN_PATH = 1
+COLUMN_SIZE = 1
 COLUMN_MTIME = 2
-max_file = 1000
+COLUMN_PIXBUF = 4
+# rows added to a tab each time its grid is scrolled near the end
+page_size = 500
+# rows left below the view when the next page is fetched
+page_margin = 100
+# Journal entries fetched by each datastore.find call, previews included
+journal_page_size = 50
+# Journal entries fetched by each datastore.find call filling the search
+# index, previews left out
+journal_index_page_size = 500
+# fill the tabs not yet shown when the main loop is idle
+prefetch_tabs = True
+# rows added to the model per main loop iteration while scanning
+scan_chunk_size = 50
+# longest time in seconds a scan step keeps the main loop busy
+scan_time_slice = 0.05
+# deepest directory level scanned below a root, no limit if not listed
+scan_depth = {}
+# longest time in seconds a mounted volume is rescanned for at startup,
+# the rest of it is scanned the next time
+volume_scan_budget = 30
+# megabytes of decoded Journal previews kept by uid and timestamp, on top
+# of thumbnail_memory
+preview_memo_memory = 4
+# milliseconds of quiet before datastore changes are applied
+journal_refresh_delay = 500
+# milliseconds of quiet in the filter box before the tab is filtered
+filter_delay = 150
+# thumbnails decoded beyond each end of the visible range
+prefetch_items = 12
+# number of thumbnail decode threads, 0 means one per core
+decode_workers = int(os.environ.get('IMAGETHUMBNAIL_WORKERS', '0'))
+# megabytes of thumbnails kept on disk by the thumbnail cache, 0 means
+# 256 or a tenth of the free space if less
+thumbnail_cache_size = int(os.environ.get('IMAGETHUMBNAIL_CACHE_MB', '0'))
+# megabytes of decoded thumbnails kept in the grids
+thumbnail_memory = int(os.environ.get('IMAGETHUMBNAIL_MEMORY_MB', '48'))
+# leave the copies of an image out of the file tabs, but for the first
+# one shown
+hide_duplicates = bool(os.environ.get('IMAGETHUMBNAIL_HIDE_DUPLICATES'))
 
 _logger = logging.getLogger('image-thumbnail')
 
-def get_mounts():
+def delete_keys(col, keys):
+    """Delete Journal entries (col 0) or files by key, returning the
+    keys that could not be deleted; runs on a worker thread"""
+    
+    failed = []
+    for key in keys:
+        try:
+            if col == 0: datastore.delete(key)
+            else: os.remove(key)
+        except Exception:
+            _logger.debug('Cannot delete %s', key, exc_info = True)
+            failed.append(key)
+    return failed
+
+def fetch_preview(object_id):
+    """Return the preview of a Journal entry fetched without it, decoded;
+    runs on a worker thread"""
     
-    volume_monitor = Gio.VolumeMonitor.get()
+    with stats.span('datastore.get'):
+        ds_object = datastore.get(object_id)
+    preview = ds_object.metadata.get('preview')
+    if not preview or preview == 'None' or len(preview) <= 4:
+        return None
+    return decode_preview(preview)
     
-    mounts = []
-    for mount in volume_monitor.get_mounts():
-        description = {}
-        description['mount_path'] = mount.get_default_location().get_path()
-        description['label'] = mount.get_name()
-        mounts.append(description)
-        
-    return mounts
+def get_timestamp(metadata):
+    """Return the timestamp of Journal metadata as a number"""
+    
+    try:
+        return float(metadata.get('timestamp') or 0)
+    except ValueError:
+        return 0.0
+        
+def get_placeholder():
+    """Return the pixbuf shown while a thumbnail is being decoded"""
+    
+    try:
+        return Gtk.IconTheme.get_default().load_icon('image-x-generic',
+            style.STANDARD_ICON_SIZE, 0)
+    except Exception:
+        return None
 
 class ImageThumbnail(activity.Activity):
     """The entry point to the Activity"""
@@ -74,8 +151,95 @@ class ImageThumbnail(activity.Activity):
         
         activity.Activity.__init__(self, handle)
         
+        with stats.span('build_canvas'):
+            self.build_canvas()
+        
+        self.set_canvas(self.canvas)
+        self.show_all()
+        
+        toolbar_box = ToolbarBox()
+        self.set_toolbar_box(toolbar_box)
+        toolbar_box.toolbar.insert(TitleEntry(self), -1)
+        
+        self.filter_entry = iconentry.IconEntry()
+        self.filter_entry.set_icon_from_name(iconentry.ICON_ENTRY_PRIMARY,
+            'entry-search')
+        self.filter_entry.add_clear_button()
+        self.filter_entry.set_width_chars(25)
+        self.filter_entry.connect('changed', self._filter_changed_cb)
+        filter_item = Gtk.ToolItem()
+        filter_item.add(self.filter_entry)
+        toolbar_box.toolbar.insert(filter_item, -1)
+        
+        separator = Gtk.SeparatorToolItem()
+        separator.props.draw = False
+        separator.set_expand(True)
+        toolbar_box.toolbar.insert(separator, -1)
+
+        toolbar_box.toolbar.insert(StopButton(self), -1)
+        toolbar_box.show_all()
+        
+        self.canvas.connect('switch-page', self._switch_page_cb)
+        # the first tab is filled once the first frame is on screen
+        self.first_paint_id = self.canvas.connect('draw',
+            self._first_paint_cb)
+        
+        datastore.created.connect(self._journal_created_cb)
+        datastore.updated.connect(self._journal_updated_cb)
+        datastore.deleted.connect(self._journal_deleted_cb)
+        stats.mark('activity_started')
+        
+    def _first_paint_cb(self, widget, cr):
+        
+        self.canvas.disconnect(self.first_paint_id)
+        stats.mark('first_paint')
+        # idle sources run after the frame being drawn is done
+        GLib.idle_add(self._start_cb)
+        return False
+        
+    def _start_cb(self):
+        
+        self.open_indexes()
+        self.load_tab(self.canvas.get_current_page())
+        return False
+        
+    def open_indexes(self):
+        """Open the scan index and set up the search indexes, once the
+        first frame is on screen"""
+        
+        from scanindex import ScanIndex
+        from searchindex import SearchIndex
+        
+        with stats.span('open_indexes'):
+            self.scan_index = ScanIndex(os.path.join(
+                activity.get_activity_root(), 'data', 'scan-index.db'))
+            self.search = [SearchIndex() for col in self.ls_journal]
+            if hide_duplicates:
+                for paths in self.scan_index.get_duplicates():
+                    self.hidden_copies.update(
+                        self.get_shown_copies(paths)[1:])
+        
+    def build_canvas(self):
+        """Set up the caches and the notebook of tabs, short of the
+        sugar window around them"""
+        
         self.selected_journal_entry = None
         self.selected_path = None
+        self.thumb_cache = ThumbnailCache(
+            os.path.join(activity.get_activity_root(), 'data', 'thumbnails'),
+            style.zoom(320), style.zoom(240),
+            thumbnail_cache_size * 1024 * 1024 or None)
+        self.decode_pool = DecodePool(decode_workers)
+        # deletions run in order on a thread of their own
+        self.delete_pool = DecodePool(1)
+        # so do fingerprints, which never wait behind decodes
+        self.hash_pool = DecodePool(1)
+        # opened by open_indexes, along with the search indexes
+        self.scan_index = None
+        # path: full fingerprint of the files fingerprinted this session
+        self.contents = {}
+        # paths of the copies left out of the file tabs
+        self.hidden_copies = set()
         
         self.canvas = Gtk.Notebook()
         self.canvas.props.show_border = True
@@ -84,45 +248,64 @@ class ImageThumbnail(activity.Activity):
         
         self.last_col = 0
         cols = 3
-        ds_mounts = get_mounts()
+        self.mounts = get_mounts()
+        # where the images shown in the tabs live, the Journal included
+        self.shown_roots = [HOME, os.path.join(env.get_profile_path(),
+            'datastore')] + get_read_only_roots() + \
+            [mount['mount_path'] for mount in self.mounts]
         # check if externmal media used in journal
-        if ds_mounts: cols = 4
+        if self.mounts: cols = 4
+        # the External tab is only there with mounts, Read Only is last
+        self.external_col = 2 if self.mounts else None
+        self.read_only_col = cols - 1
+        # root: ScanIndex of the volume mounted there
+        self.volume_indexes = {}
+        self.volume_directory = os.path.join(activity.get_activity_root(),
+            'data', 'volumes')
         
         self.ls_journal = []
-        self.tv_journal = []
-        self.col_journal = []
-        self.column_table = []
+        self.icon_view = []
         self.scroll = []
         self.vbox = []
-        self.hidden = []
-        self.image = [[],[],[],[],[]]
-        self.btn_delete = [[],[],[],[],[]]
-        self.btn_show = [[],[],[],[],[]]
-        self.title_entry = [[],[],[],[],[]]
+        self.loaded = set()
+        self.window = []
+        self.pages = []
+        self.page_end = []
+        self.scans = []
+        self.scan_id = []
+        self.volume_scans = []
+        self.preview_memo = OrderedDict()
+        self.preview_memo_bytes = 0
+        self.pixbuf_budget = PixbufBudget(thumbnail_memory * 1024 * 1024)
+        # (col, key) of the thumbnails in view on the current tab
+        self.visible = set()
+        self.journal_changes = {}
+        self.journal_changes_id = None
+        self.rows = []
+        self.search = []
+        # the filter text and the text each tab is filtered with
+        self.filter_text = ''
+        self.filter_id = None
+        self.filters = []
+        self.roots = []
+        self.watchers = []
+        self.requested = []
+        self.load_visible_id = []
         self.tab_label = []
+        self.placeholder = get_placeholder()
         
         for col in range(cols):
 
             self.ls_journal.append(
                 Gtk.ListStore(GObject.TYPE_STRING,
                 GObject.TYPE_UINT64,
-                GObject.TYPE_STRING,
-                GObject.TYPE_PYOBJECT))
+                GObject.TYPE_DOUBLE,
+                GObject.TYPE_PYOBJECT,
+                GdkPixbuf.Pixbuf))
+            # rows are inserted in place, newest first
+            self.ls_journal[col].set_sort_column_id(COLUMN_MTIME,
+                Gtk.SortType.DESCENDING)
                 
-            self.tv_journal.append( Gtk.TreeView(self.ls_journal[col]))
-            self.tv_journal[col].set_rules_hint(True)
-            self.tv_journal[col].set_search_column(COLUMN_TITLE)
-            
-            renderer = Gtk.CellRendererText()
-            renderer.set_property('wrap-mode', Gtk.WrapMode.WORD)
-            renderer.set_property('wrap-width', 500)
-            renderer.set_property('width', 500)
-            
-            self.col_journal.append(Gtk.TreeViewColumn(_('Title'),
-                renderer, text = COLUMN_TITLE))
-            self.col_journal[col].set_sort_column_id(COLUMN_MTIME)
-            self.tv_journal[col].append_column(self.col_journal[col])
-        
             # FIXME: have to change everything about pango
             # label_attributes = Pango.AttrList()
             # label_attributes.insert(Pango.AttrSize(14000, 0, -1))
@@ -134,7 +317,7 @@ class ImageThumbnail(activity.Activity):
             elif col == 1:
                 self.tab_label.append(Gtk.Label(_("Files")))
                 
-            elif (cols == 4 and col == 2):
+            elif col == self.external_col:
                 self.tab_label.append(Gtk.Label(_("External")))
                 
             else:
@@ -143,152 +326,277 @@ class ImageThumbnail(activity.Activity):
             # FIXME: have to change everything about pango
             #self.tab_label[col].set_attributes(label_attributes)
             #self.tab_label[col].show()
-            #self.tv_journal[col].show()
-            if col == 0: self.load_journal_table(col)
-            else: self.load_file_table(col)
-            
-            num = self.ls_journal[col].iter_n_children(None)
-            
-            if num == 0:
-                #dummy elements for no external files
-                self.column_table.append( Gtk.Table(1, 1, homogeneous = False))
-                self.scroll.append(Gtk.ScrolledWindow(hadjustment = None,
-                    vadjustment = None))
-                self.vbox.append(Gtk.VBox(homogeneous = True, spacing=5))
-                self.canvas.append_page(self.vbox[col],self.tab_label[col])
-                self.tab_label[col].hide()
-                self.vbox[col].hide()
-                self.hidden.append(col)
-                
-            else:
-                self.tab_label[col].show()
-                self.tv_journal[col].show()
-            
-            self.column_table.append( Gtk.Table(rows = num,
-                columns = 3, homogeneous = False))
-            self.scroll.append(Gtk.ScrolledWindow(hadjustment = None,
-                vadjustment = None))
-            self.scroll[col].set_policy(Gtk.PolicyType.AUTOMATIC,
-                Gtk.PolicyType.AUTOMATIC)
-            
-            iter = self.ls_journal[col].get_iter_first()
-            n=0
-            
-            while(iter != None):
-                tv = self.tv_journal[col]
-                model = tv.get_model()
-                
-                jobject = model.get_value(iter,COLUMN_JOBJECT)
-                
-                i = n - (3 * int(n / 3))
-                j = 2 * int( n / 3)
-                image_table = Gtk.Table(rows = 2, columns = 2, homogeneous = False)
-                
-                self.image[col].append( Gtk.Image())
-                image_table.attach(self.image[col][n], 0, 2, 0, 1,
-                    xoptions = Gtk.AttachOptions.FILL |
-                    Gtk.AttachOptions.SHRINK,
-                    yoptions = Gtk.AttachOptions.FILL |
-                    Gtk.AttachOptions.SHRINK,
-                    xpadding = 5, ypadding = 5)
-                    
-                self.btn_show[col].append(Gtk.Button(_("Show File")))
-                self.btn_show[col][n].connect('button_press_event',
-                    self.show_button_press_event_cb, col,n)
-                    
-                image_table.attach(self.btn_show[col][n], 0, 1, 1, 2,
-                    xoptions = Gtk.AttachOptions.SHRINK,
-                    yoptions = Gtk.AttachOptions.SHRINK,
-                    xpadding = 5, ypadding = 5)
-                self.btn_show[col][n].show()
-                
-                if col < cols - 1:
-                    self.btn_delete[col].append(Gtk.Button(_("Delete")))
-                    self.btn_delete[col][n].connect('button_press_event',
-                        self.delete_button_press_event_cb, col,n)
-                        
-                    image_table.attach(self.btn_delete[col][n], 1, 2, 1, 2,
-                        xoptions = Gtk.AttachOptions.SHRINK,
-                        yoptions = Gtk.AttachOptions.SHRINK,
-                        xpadding = 5, ypadding = 5)
-                    self.btn_delete[col][n].show()
-                    self.btn_delete[col][n].props.sensitive = True
-                    
-                image_table.show()
-                
-                self.column_table[col].attach(image_table, i, i+1, j+1, j+2,
-                    xoptions = Gtk.AttachOptions.FILL |
-                    Gtk.AttachOptions.EXPAND |
-                    Gtk.AttachOptions.SHRINK,
-                    yoptions = Gtk.AttachOptions.FILL |
-                    Gtk.AttachOptions.EXPAND |
-                    Gtk.AttachOptions.SHRINK,
-                    xpadding = 5, ypadding = 5)
-                    
-                self.set_form_fields(jobject,col,n)
-                self.btn_show[col][n].props.sensitive = True
-                
-                iter=self.ls_journal[col].iter_next(iter)
-                n+=1
-                
-            self.scroll[col].add_with_viewport(self.column_table[col])
-            self.scroll[col].set_events(Gdk.EventMask.POINTER_MOTION_MASK)
-            self.scroll[col].show()
-            self.vbox.append(Gtk.VBox(homogeneous=True, spacing=5))
-            self.vbox[col].pack_start(self.scroll[col], True, True, 0)
+            # tabs are filled by load_tab the first time they are shown
+            self.requested.append(set())
+            self.load_visible_id.append(None)
+            self.window.append(0)
+            self.pages.append(None)
+            self.page_end.append(None)
+            self.scans.append(None)
+            self.scan_id.append(None)
+            self.volume_scans.append([])
+            self.rows.append({})
+            self.search.append(None)
+            self.filters.append('')
+            self.roots.append([])
+            self.watchers.append(None)
+            self.vbox.append(self.draw_grid(col, col < cols - 1))
             self.canvas.append_page(self.vbox[col], self.tab_label[col])
+            self.tab_label[col].show()
             
-        self.tab_label.append(Gtk.Label(_("File Viewer")))
-        # FIXME: have to change everything about pango
-        #self.tab_label[cols].set_attributes(label_attributes)
-        self.tab_label[cols].show()
-        self.vbox_view=self.draw_metatable(cols)
-        self.canvas.append_page(self.vbox_view, self.tab_label[cols])
-
-        self.set_canvas(self.canvas)
-        self.show_all()
-        self.vbox_view.hide()
-        self.tab_label[cols].hide()
+        # the File Viewer is built by get_detail_view when first needed
+        self.vbox_view = None
+        
+    def _switch_page_cb(self, notebook, page, page_num):
+        
+        # _start_cb loads the current tab
+        if self.scan_index is None: return
+        if page_num < len(self.ls_journal):
+            self.load_tab(page_num)
+            if self.filters[page_num] != self.filter_text:
+                self.apply_filter(page_num)
+            self.queue_load_visible(page_num)
+            
+    def _filter_changed_cb(self, entry):
+        
+        self.filter_text = entry.get_text().strip()
+        if self.filter_id is not None:
+            GLib.source_remove(self.filter_id)
+        self.filter_id = GLib.timeout_add(filter_delay, self._filter_cb)
+        
+    def _filter_cb(self):
+        
+        # try again once the search indexes are there
+        if self.scan_index is None: return True
+        self.filter_id = None
+        col = self.canvas.get_current_page()
+        if col < len(self.ls_journal) and \
+            self.filters[col] != self.filter_text:
+            self.apply_filter(col)
+        return False
+        
+    def apply_filter(self, col):
+        """Narrow a tab to the entries matching the filter text from the
+        search index, or page all of them in again once it is cleared.
+        
+        The rows shown that still match stay in place with their
+        thumbnails; only the others are taken off the tab."""
+        
+        self.filters[col] = self.filter_text
+        if self.pages[col] is not None:
+            self.pages[col].close()
+            self.pages[col] = None
+        self.window[col] = 0
+        
+        if self.filter_text:
+            keys = self.search[col].search(self.filter_text)
+            matches = set(keys)
+            for key in list(self.rows[col]):
+                if key not in matches: self.drop_row(col, key)
+            self.pages[col] = self.match_pages(col, keys)
+        elif col == 0 and self.scans[col] is not None:
+            # the Journal is still being indexed
+            self.pages[col] = self.journal_pages(col)
+        elif col == 0:
+            self.pages[col] = self.match_pages(col, self.search[col].keys())
+        else:
+            self.page_end[col] = ()
+            self.pages[col] = self.file_pages(col)
+        self.load_next_page(col)
         
-        toolbar_box = ToolbarBox()
-        self.set_toolbar_box(toolbar_box)
-        toolbar_box.toolbar.insert(TitleEntry(self), -1)
-        separator = Gtk.SeparatorToolItem()
-        separator.props.draw = False
-        separator.set_expand(True)
-        toolbar_box.toolbar.insert(separator, -1)
-
-        toolbar_box.toolbar.insert(StopButton(self), -1)
-        toolbar_box.show_all()
+    def match_pages(self, col, keys):
+        """Yield the rows of keys, page_size at a time, newest first.
         
-        for n in self.hidden:
-            self.tab_label[n].hide()
-            self.vbox[n].hide()
-    #can use in future to load in background
-
-    def motion_notify_event(self,widget,event,col):
+        The matches go through a heap, so only the ones paged in are
+        ever put in order."""
+        
+        search = self.search[col]
+        if col == 0:
+            heap = [(-get_timestamp(search.get(key).metadata), key)
+                for key in keys]
+        else:
+            heap = [(-search.get(key).mtime, key) for key in keys]
+        heapq.heapify(heap)
+        
+        while heap:
+            rows = []
+            while heap and len(rows) < page_size:
+                key = heapq.heappop(heap)[1]
+                if key not in search or key in self.rows[col]: continue
+                if col == 0:
+                    rows.append(self.make_journal_row(search.get(key)))
+                else:
+                    rows.append(self.make_file_row(search.get(key)))
+            yield rows
+            
+    def clear_tab(self, col):
+        
+        if self.pages[col] is not None:
+            self.pages[col].close()
+            self.pages[col] = None
+        for key in self.rows[col]:
+            self.pixbuf_budget.remove((col, key))
+        self.ls_journal[col].clear()
+        self.rows[col].clear()
+        self.requested[col].clear()
+        self.window[col] = 0
+            
+    def load_tab(self, col):
+        """Scan and fill a tab the first time it is needed"""
+        
+        if col in self.loaded: return
+        self.loaded.add(col)
         
-        self.tv_journal[col].show()
-        self.scroll[col]= Gtk.ScrolledWindow(
-            hadjustment=None, vadjustment=None)
+        # tab_loaded is called when the scan is done
+        if col == 0: self.load_journal_table(col)
+        else: self.load_file_table(col)
+            
+    def tab_loaded(self, col):
+        
+        stats.mark('tab_loaded:%d' % col)
+        # the search index is complete now, show all the matches
+        if self.filters[col]: self.apply_filter(col)
+        if self.ls_journal[col].iter_n_children(None) == 0 and \
+            not self.filters[col] and self.canvas.get_current_page() != col:
+            #no entries, e.g. no external files
+            self.tab_label[col].hide()
+            self.vbox[col].hide()
+        else:
+            self.queue_load_visible(col)
+            
+        if col != 0: self.start_watching(col)
+        
+        if prefetch_tabs and len(self.loaded) < len(self.ls_journal):
+            GLib.idle_add(self._prefetch_tab_cb, priority = GLib.PRIORITY_LOW)
+            
+    def _prefetch_tab_cb(self):
+        
+        for col in range(len(self.ls_journal)):
+            if col not in self.loaded:
+                self.load_tab(col)
+                break
+        return False
+        
+    def draw_grid(self, col, deletable):
+        """Build the thumbnail grid of a tab on top of its ListStore.
+        
+        Only the cells in view are painted and only the rows near the
+        visible range get their thumbnail decoded."""
+        
+        self.icon_view.append(Gtk.IconView(model = self.ls_journal[col]))
+        icon_view = self.icon_view[col]
+        icon_view.set_selection_mode(Gtk.SelectionMode.MULTIPLE)
+        
+        renderer = Gtk.CellRendererPixbuf()
+        renderer.set_fixed_size(style.zoom(320), style.zoom(240))
+        icon_view.pack_start(renderer, False)
+        icon_view.add_attribute(renderer, 'pixbuf', COLUMN_PIXBUF)
+        
+        icon_view.connect('item-activated', self._item_activated_cb, col)
+        icon_view.connect('size-allocate', self._grid_allocate_cb, col)
+        icon_view.show()
+        
+        self.scroll.append(Gtk.ScrolledWindow(hadjustment = None,
+            vadjustment = None))
         self.scroll[col].set_policy(Gtk.PolicyType.AUTOMATIC,
             Gtk.PolicyType.AUTOMATIC)
-        self.menu_file()
+        self.scroll[col].add(icon_view)
+        self.scroll[col].get_vadjustment().connect('value-changed',
+            self._scroll_changed_cb, col)
         self.scroll[col].show()
-        self.vbox[col] = Gtk.VBox(homogeneous=True, spacing=5)
-        self.vbox[col].pack_start(self.scroll[col], True, True, 0)
         
-        widget.append_page(sef.vbox[col], self.tab_label[col])
-        widget.show()
-        #reload
-
-    def remove_image(self, col,id):
+        button_box = Gtk.HBox(homogeneous = False, spacing = 5)
+        btn_show = Gtk.Button(_("Show File"))
+        btn_show.connect('button_press_event',
+            self.show_button_press_event_cb, col)
+        button_box.pack_start(btn_show, False, False, 5)
+        btn_show.show()
+        
+        if deletable:
+            btn_delete = Gtk.Button(_("Delete"))
+            btn_delete.connect('button_press_event',
+                self.delete_button_press_event_cb, col)
+            button_box.pack_start(btn_delete, False, False, 5)
+            btn_delete.show()
+        button_box.show()
         
-        iter = self.ls_journal[col].get_iter_first()
-        n = 0
-        tv = self.tv_journal[col]
-        model = tv.get_model()
-        self.image[col][id].hide()
+        vbox = Gtk.VBox(homogeneous = False, spacing = 5)
+        vbox.pack_start(self.scroll[col], True, True, 0)
+        vbox.pack_start(button_box, False, False, 5)
+        return vbox
+        
+    def _grid_allocate_cb(self, icon_view, allocation, col):
+        
+        self.queue_load_visible(col)
+        
+    def _scroll_changed_cb(self, adjustment, col):
+        
+        self.queue_load_visible(col)
+        
+    def queue_load_visible(self, col):
+        
+        if self.load_visible_id[col] is None:
+            self.load_visible_id[col] = GLib.idle_add(self.load_visible, col)
+            
+    def load_visible(self, col):
+        """Request thumbnails for the rows in view, plus a margin"""
+        
+        self.load_visible_id[col] = None
+        visible = self.icon_view[col].get_visible_range()
+        if visible is None: return False
+        
+        model = self.ls_journal[col]
+        first = max(0, visible[0].get_indices()[0] - prefetch_items)
+        last = visible[1].get_indices()[0] + prefetch_items
+        
+        if self.pages[col] is not None and \
+            last - prefetch_items + page_margin >= model.iter_n_children(None):
+            self.load_next_page(col)
+        
+        in_view = set()
+        n = first
+        iter = model.get_iter(Gtk.TreePath(first))
+        while(iter != None and n <= last):
+            jobject = model.get_value(iter, COLUMN_JOBJECT)
+            key = jobject.get_object_id()
+            in_view.add((col, key))
+            if key not in self.requested[col]:
+                self.requested[col].add(key)
+                self.set_form_fields(jobject, col, key)
+            else:
+                self.pixbuf_budget.touch((col, key))
+            iter = model.iter_next(iter)
+            n += 1
+            
+        if col == self.canvas.get_current_page():
+            self.visible = in_view
+        return False
+        
+    def get_selected_keys(self, col):
+        
+        return [self.get_key(col, path)
+            for path in self.icon_view[col].get_selected_items()]
+        
+    def get_key(self, col, path):
+        """Return the key of the entry shown at path"""
+        
+        model = self.ls_journal[col]
+        jobject = model.get_value(model.get_iter(path), COLUMN_JOBJECT)
+        return jobject.get_object_id()
+        
+    def get_detail_view(self):
+        """Return the File Viewer page, adding it to the notebook the
+        first time an entry is shown"""
+        
+        if self.vbox_view is None:
+            cols = len(self.ls_journal)
+            self.tab_label.append(Gtk.Label(_("File Viewer")))
+            # FIXME: have to change everything about pango
+            #self.tab_label[cols].set_attributes(label_attributes)
+            self.vbox_view=self.draw_metatable(cols)
+            self.vbox_view.show_all()
+            self.canvas.append_page(self.vbox_view, self.tab_label[cols])
+        return self.vbox_view
         
     def draw_metatable(self, col):
         
@@ -423,43 +731,45 @@ class ImageThumbnail(activity.Activity):
         self.detail_view.show()
         return self._secondary_view
 
-    def show_button_press_event_cb(self, entry, event, col,row):
+    def show_button_press_event_cb(self, entry, event, col):
+        
+        selected = self.icon_view[col].get_selected_items()
+        if selected: self.show_entry(col, self.get_key(col, selected[0]))
+        
+    def _item_activated_cb(self, icon_view, path, col):
+        
+        self.show_entry(col, self.get_key(col, path))
+        
+    def show_entry(self, col, key):
+        
+        iter = self.rows[col].get(key)
+        if iter is None: return
+        jobject = self.ls_journal[col].get_value(iter, COLUMN_JOBJECT)
         
         # Need to get the full set of properties
-        iter = self.ls_journal[col].get_iter_first()
-        n = 0
-        tv = self.tv_journal[col]
-        model = tv.get_model()
+        metadata = jobject.get_file_metadata()
+        self.get_detail_view()
         
-        while(iter != None and n < (row)):
-            iter = self.ls_journal[col].iter_next(iter)
-            n += 1
-            jobject = model.get_value(iter,COLUMN_JOBJECT)
+        try:
+            scaled_buf = self.show_image(jobject.get_file_path())
+            self.large_image.set_from_pixbuf(scaled_buf)
+        except Exception:
+            logging.error('Exception while displaying entry', exc_info = True)
+            # rather than the picture of the entry shown before
+            self.large_image.clear()
             
-            object_id = jobject.get_object_id()
-            metadata = jobject.get_file_metadata()
+        title_textbuf = self.title_textview.get_buffer()
+        title_textbuf.set_text(metadata['title'] or '')
+        desc_textbuf = self.description_textview.get_buffer()
+        desc_textbuf.set_text(metadata['description'] or '')
+        
+        mime_textbuf = self.mime_textview.get_buffer()
+        mime_textbuf.set_text(metadata['mime_type'])
+        mtime_textbuf = self.mtime_textview.get_buffer()
+        #time from curent
+        mtime=time.asctime(time.localtime(float(metadata['timestamp'])))
+        mtime_textbuf.set_text(str(mtime))
         
-            try:
-                scaled_buf = self.show_image(jobject.get_file_path())
-                self.large_image.set_from_pixbuf(scaled_buf)
-            except Exception:
-                logging.error('Exception while displaying entry:\n' + \
-                ''.join(traceback.format_exception(*sys.exc_info())))
-            
-            title_textbuf = self.title_textview.get_buffer()
-            if metadata['title'] != None: title_textbuf.set_text(metadata['title'])
-            desc_textbuf = self.description_textview.get_buffer()
-            
-            if metadata['description']!=None:
-                desc_textbuf.set_text(metadata['description'])
-                
-            mime_textbuf = self.mime_textview.get_buffer()
-            mime_textbuf.set_text(metadata['mime_type'])
-            mtime_textbuf = self.mtime_textview.get_buffer()
-            #time from curent
-            mtime=time.asctime(time.localtime(float(metadata['timestamp'])))
-            mtime_textbuf.set_text(str(mtime))
-            
         self._secondary_view.show()
         self.vbox_view.show()
         self.canvas.set_current_page(len(self.vbox))
@@ -471,315 +781,954 @@ class ImageThumbnail(activity.Activity):
         self.vbox_view.hide()
         self.canvas.set_current_page(self.last_col)
         
-    def delete_button_press_event_cb(self, entry, event, col,id):
-        
-        i = 0
-        tv = self.tv_journal[col]
-        model = tv.get_model()
-        iter = self.ls_journal[col].get_iter_first()
-        
-        while(i < id):
-            iter = self.ls_journal[col].iter_next(iter)
-            i += 1
+    def delete_button_press_event_cb(self, entry, event, col):
+        
+        keys = self.get_selected_keys(col)
+        if keys: self.delete_entries(col, keys)
+        
+    def delete_entries(self, col, keys):
+        """Take the entries of keys off a tab right away and delete them
+        on a worker thread; the ones that cannot be deleted come back"""
+        
+        removed = []
+        for key in keys:
+            iter = self.rows[col].get(key)
+            row = None
+            if iter is not None:
+                row = list(self.ls_journal[col].get(iter,
+                    *range(COLUMN_PIXBUF))) + [None]
+            payload = None
+            if key in self.search[col]:
+                payload = self.search[col].get(key)
+            removed.append((key, row, payload))
+            self.remove_row(col, key)
             
-        if not iter == None:
-            jobject = model.get_value(iter,COLUMN_JOBJECT)
-            self.ls_journal[col].remove(iter)
-            
-            if col == 0:
-                datastore.delete(jobject.get_object_id())
-                
-            else:
-                try:
-                    os.remove(jobject.get_file_path())
-                    print 'Deleted %s' % (jobject.get_file_path())
-                except OSError: print 'Cannot delete %s' % (jobject.get_file_path())
+        self.delete_pool.submit(delete_keys, (col, keys),
+            self._entries_deleted_cb, col, removed)
+        self.icon_view[col].grab_focus()
+        self.last_col = col
+        
+    def _entries_deleted_cb(self, failed, col, removed):
+        
+        # None if delete_keys itself failed
+        if failed is None:
+            failed = [key for key, row, payload in removed]
+        failed = set(failed)
+        
+        deleted = []
+        for key, row, payload in removed:
+            if key not in failed:
+                deleted.append(key)
+                continue
+            _logger.warning('Cannot delete %s', key)
+            if payload is not None:
+                if col == 0: self.index_journal_entry(payload)
+                else: self.index_entry(col, payload)
+            if row is not None:
+                self.add_row(col, row)
                 
-            self.remove_image(col,id)
-            self.tv_journal[col].grab_focus()
-            self.last_col = col
-            
+        # the thumbnails and the scan index only let go of the files
+        # actually gone, or the next page would bring them back before
+        # a rescan
+        if col == 0:
+            for key in deleted:
+                self.forget_fingerprint(get_journal_path(
+                    env.get_profile_path(), key))
+        else:
+            for key in deleted:
+                self.thumb_cache.invalidate(key)
+                self.forget_fingerprint(key)
+            for root in self.roots[col]:
+                paths = [key for key in deleted if key.startswith(root + '/')]
+                if paths: self.get_index(root).remove_files(root, paths)
+        if failed: self.queue_load_visible(col)
+        
     def close(self,  skip_save = False):
         "Override the close method so we don't try to create a Journal entry."
         
+        self.cancel_scans()
+        self.stop_watching()
+        if self.journal_changes_id is not None:
+            GLib.source_remove(self.journal_changes_id)
+            self.journal_changes_id = None
+        if self.filter_id is not None:
+            GLib.source_remove(self.filter_id)
+            self.filter_id = None
+        self.decode_pool.stop()
+        self.delete_pool.stop()
+        self.hash_pool.stop()
+        if self.scan_index is not None: self.scan_index.close()
+        for scan_index in self.volume_indexes.values():
+            scan_index.close()
+        stats.dump()
         activity.Activity.close(self, True)
         
-    def set_form_fields(self, jobject, col = 0, id = 0):
+    def set_form_fields(self, jobject, col, key):
         #no title
-        #self.title_entry[col][id].set_text(jobject.get_title())
         if col == 0:
-            self.create_preview(jobject.get_object_id(), col, id)
+            self.create_preview(jobject, col, key)
         else:
             filename = jobject.get_file_path()
-            self.show_image(filename, col, id)
+            self.show_image(filename, col, key)
             
-    def create_preview(self, object_id, col, id):
-        
-        jobject = datastore.get(object_id)
-        
-        if jobject.metadata.has_key('preview'):
-            preview = jobject.metadata['preview']
-            if preview is None or preview == '' or preview == 'None':
-                if (jobject.metadata['mime_type'].startswith('image/')):
-                    # or (jobject.metadata['mime_type'].startswith('video')):
-                    filename = jobject.get_file_path()
-                    self.show_image(filename,col,id)
-                    return
-                
-        if jobject.metadata.has_key('preview') and \
-            len(jobject.metadata['preview']) > 4:
+    def create_preview(self, jobject, col, key):
+        
+        # the preview was fetched along with the entry by journal_pages;
+        # the entries only paged in from the search index come without
+        # one and are shown from their file, as are the images whose
+        # preview was dropped once decoded, or have it fetched if videos
+        metadata = jobject.get_file_metadata()
+        
+        memo_key = (jobject.get_object_id(), metadata.get('timestamp'))
+        if memo_key in self.preview_memo:
+            stats.count('preview_memo_hits')
+            self.set_thumbnail(col, key, self.preview_memo[memo_key])
+            return
             
-            if jobject.metadata['preview'][1:4] == 'PNG':
-                preview_data = jobject.metadata['preview']
-            else:
-                import base64
-                preview_data = base64.b64decode(jobject.metadata['preview'])
+        preview = metadata.get('preview')
+        if preview is None or preview == '' or preview == 'None':
+            if (metadata['mime_type'].startswith('image/')):
+                # or (metadata['mime_type'].startswith('video')):
+                filename = get_journal_file(env.get_profile_path(),
+                    key) or jobject.get_file_path()
+                self.show_image(filename,col,key)
+                return
                 
-            loader = Gdk.PixbufLoader()
-            loader.write(preview_data)
-            scaled_buf = loader.get_pixbuf()
-            loader.close()
-            self.image[col][id].set_from_pixbuf(scaled_buf)
-            self.image[col][id].show()
+        if preview is not None and len(preview) > 4:
+            self.set_placeholder(col, key)
+            self.decode_pool.submit(decode_preview, (preview,),
+                self._preview_decoded_cb, memo_key, metadata, col, key)
+        elif 'preview' not in metadata:
+            self.set_placeholder(col, key)
+            self.decode_pool.submit(fetch_preview, (key,),
+                self._preview_decoded_cb, memo_key, metadata, col, key)
         else:
-            self.image[col][id].clear()
-            self.image[col][id].show()
+            self.set_thumbnail(col, key, None)
+            
+    def _preview_decoded_cb(self, scaled_buf, memo_key, metadata, col, key):
+        
+        if scaled_buf is not None:
+            self.memo_preview(memo_key, scaled_buf)
+            # an image can be shown from its file again, a video needs
+            # its preview
+            if metadata['mime_type'].startswith('image/'):
+                metadata.pop('preview', None)
+        self._thumbnail_decoded_cb(scaled_buf, memo_key[0], col, key)
+        
+    def memo_preview(self, memo_key, pixbuf):
+        """Keep a decoded preview, dropping the oldest ones past
+        preview_memo_memory"""
+        
+        old = self.preview_memo.pop(memo_key, None)
+        if old is not None:
+            self.preview_memo_bytes -= old.get_rowstride() * old.get_height()
+        self.preview_memo[memo_key] = pixbuf
+        self.preview_memo_bytes += pixbuf.get_rowstride() * pixbuf.get_height()
+        while self.preview_memo_bytes > preview_memo_memory * 1024 * 1024:
+            memo_key, pixbuf = self.preview_memo.popitem(last = False)
+            self.preview_memo_bytes -= \
+                pixbuf.get_rowstride() * pixbuf.get_height()
             
     def load_file_table(self,col):
         
-        self.num = 0
-        if col == 2:
-            ds_mounts = get_mounts()
-            
-            if ds_mounts:
-                for mount in ds_mounts:
-                    self.load_files(mount['mount_path'], col)
-            else:
-                self.tab_label[col].hide()
-                
+        from volumes import VolumeScan
+        from volumes import open_volume_index
+        
+        roots = []
+        if col == self.external_col:
+            for mount in self.mounts:
+                roots.append(mount['mount_path'])
+                self.volume_indexes[mount['mount_path']] = \
+                    open_volume_index(self.volume_directory, mount,
+                    self.thumb_cache, self.scan_index)
+                    
         elif col == 1:
-            self.load_files('/home/olpc',col)
+            roots.append(HOME)
             
         else:
-            f = open('olpc.files','r')
-            for line in f:
-                line = line.strip()
-                self.load_files(os.path.join('/home/olpc', line), col)
-                if self.num > max_file: break
-            f.close()
-        # FIXME: object has no attribute SORT_DESCENDING
-        #self.ls_journal[col].set_sort_column_id(COLUMN_MTIME,  Gtk.SORT_DESCENDING)
+            roots = get_read_only_roots()
+        self.start_scan(col, roots)
+        
+        # volumes are rescanned on threads of their own, so a slow one
+        # holds up neither the others nor the activity
+        if col == self.external_col:
+            for mount in self.mounts:
+                self.volume_scans[col].append(VolumeScan(
+                    self.volume_directory, mount,
+                    get_scan_rules(mount['mount_path']), volume_scan_budget,
+                    scan_depth.get(mount['mount_path']),
+                    self._volume_scanned_cb, self._volume_scan_done_cb, col))
+        
+    def get_index(self, root):
+        """Return the ScanIndex holding root"""
+        
+        return self.volume_indexes.get(root, self.scan_index)
+        
+    def get_page(self, col, after, limit):
+        """Return a page of the images under the roots of a tab, from
+        the scan index of each root, like ScanIndex.get_page"""
+        
+        indexes = OrderedDict()
+        for root in self.roots[col]:
+            indexes.setdefault(self.get_index(root), []).append(root)
+        if len(indexes) == 1:
+            scan_index, roots = indexes.popitem()
+            return scan_index.get_page(roots, after, limit)
+            
+        pages = [[((-entry.mtime, entry.path), entry)
+            for entry in scan_index.get_page(roots, after, limit)]
+            for scan_index, roots in indexes.items()]
+        entries = []
+        for sort_key, entry in heapq.merge(*pages):
+            if entries and entries[-1].path == entry.path: continue
+            entries.append(entry)
+            if len(entries) == limit: break
+        return entries
+        
+    def start_scan(self, col, roots):
+        """Fill a tab with the first page of the scan index of roots
+        right away, then rescan the roots one chunk per main loop
+        iteration so changes show up while the scan runs"""
+        
+        self.roots[col] = roots
+        self.window[col] = 0
+        self.page_end[col] = ()
+        self.pages[col] = self.file_pages(col)
+        self.load_next_page(col)
+        
+        self.scans[col] = self.scan_chunks(roots, col)
+        self.scan_id[col] = GLib.idle_add(self._scan_step_cb, col)
+        
+    def scan_chunks(self, roots, col):
+        """Group the changes found by load_files into chunks of
+        (rows, removed), giving up a chunk early when the walk has taken
+        scan_time_slice seconds.
+        
+        The search index is first filled, a page per chunk, with the
+        images the scan index already knows."""
+        
+        after = None
+        while True:
+            entries = self.get_page(col, after, page_size)
+            for entry in entries:
+                self.index_entry(col, entry)
+            if len(entries) < page_size: break
+            after = (entries[-1].mtime, entries[-1].path)
+            yield [], []
+            
+        rows = []
+        removed = []
+        start = time.time()
+        for dir in roots:
+            if dir in self.volume_indexes: continue
+            for added, gone in self.load_files(dir, col):
+                rows.extend(added)
+                removed.extend(gone)
+                if len(rows) + len(removed) >= scan_chunk_size or \
+                    time.time() - start > scan_time_slice:
+                    yield rows, removed
+                    rows = []
+                    removed = []
+                    start = time.time()
+        if rows or removed: yield rows, removed
+        
+    def _scan_step_cb(self, col):
+        
+        try:
+            with stats.span('scan_step'):
+                rows, removed = next(self.scans[col])
+        except StopIteration:
+            self.scans[col] = None
+            self.scan_id[col] = None
+            if not self.volume_scans[col]: self.tab_loaded(col)
+            return False
+            
+        for key in removed:
+            self.remove_row(col, key)
+        for row in rows:
+            self.add_row(col, row)
+        if rows or removed: self.queue_load_visible(col)
+        self.limit_window(col)
+        return True
+        
+    def limit_window(self, col):
+        
+        # a scan adds the images newer than the page end as it finds them,
+        # the oldest rows past the window go back to the pages
+        if self.filters[col] or not self.window[col] or \
+            len(self.rows[col]) <= self.window[col]:
+            return
+            
+        model = self.ls_journal[col]
+        keys = sorted((-model.get_value(iter, COLUMN_MTIME), key)
+            for key, iter in self.rows[col].items())
+        for mtime, key in keys[self.window[col]:]:
+            self.drop_row(col, key)
+        mtime, key = keys[self.window[col] - 1]
+        self.page_end[col] = (-mtime, key)
+        if self.pages[col] is None:
+            self.pages[col] = self.file_pages(col)
+            
+    def _volume_scanned_cb(self, added, removed, col):
+        
+        # the fingerprints are kept in the main scan index
+        for key in removed:
+            self.forget_fingerprint(key)
+            self.remove_row(col, key)
+        for entry in added:
+            self.forget_fingerprint(entry.path)
+            self.hidden_copies.discard(entry.path)
+            self.index_entry(col, entry)
+            if self.in_window(col, entry):
+                self.add_row(col, self.make_file_row(entry))
+        self.queue_load_visible(col)
+        self.limit_window(col)
+        
+    def _volume_scan_done_cb(self, scan, complete, col):
+        
+        if not complete:
+            _logger.debug('Scan of %s stopped, the rest is scanned next '
+                'time', scan.root)
+        self.volume_scans[col].remove(scan)
+        if not self.volume_scans[col] and self.scans[col] is None:
+            self.tab_loaded(col)
+        
+    def cancel_scans(self):
+        
+        for col in range(len(self.scans)):
+            if self.scan_id[col] is not None:
+                GLib.source_remove(self.scan_id[col])
+                self.scan_id[col] = None
+            if self.scans[col] is not None:
+                self.scans[col].close()
+                self.scans[col] = None
+            if self.pages[col] is not None:
+                self.pages[col].close()
+                self.pages[col] = None
+            for scan in self.volume_scans[col]:
+                scan.cancel()
+            del self.volume_scans[col][:]
+                
+    def add_row(self, col, row, position = -1):
+        """Add row to a tab, updating the row with the same key in place"""
+        
+        key = row[COLUMN_JOBJECT].get_object_id()
+        if key in self.hidden_copies: return
+        model = self.ls_journal[col]
+        iter = self.rows[col].get(key)
+        if iter is not None:
+            model.set(iter, range(COLUMN_PIXBUF), row[:COLUMN_PIXBUF])
+            model.set_value(iter, COLUMN_PIXBUF, None)
+            self.requested[col].discard(key)
+            self.pixbuf_budget.remove((col, key))
+        else:
+            # a full row is added with a single insert_with_valuesv, and
+            # ListStore iters stay valid until their row is removed
+            self.rows[col][key] = model.insert(position, row)
+            
+    def remove_row(self, col, key):
+        
+        self.drop_row(col, key)
+        self.search[col].remove(key)
+        
+    def drop_row(self, col, key):
+        """Take the row of key off a tab, leaving it in the search index"""
+        
+        iter = self.rows[col].pop(key, None)
+        if iter is not None:
+            self.ls_journal[col].remove(iter)
+            self.requested[col].discard(key)
+            self.pixbuf_budget.remove((col, key))
+            
+    def make_file_row(self, entry):
+        
+        jobject_wrapper = JobjectWrapper()
+        jobject_wrapper.set_file_path(entry.path)
+        jobject_wrapper.set_object_id(entry.path)
+        jobject_wrapper.set_title(entry.name)
+        jobject_wrapper.set_mime_type(entry.mime_type)
+        jobject_wrapper.set_timestamp(entry.mtime)
+        jobject_wrapper.set_description(entry.path)
+        return [entry.name, entry.size, entry.mtime, jobject_wrapper, None]
         
     def load_files(self, dir, col):
+        """Rescan dir through the scan index and yield, for every
+        directory visited, the rows of new or changed images and the
+        keys of the images that went away."""
+        
+        #remove hidden files except for readonly
+        for path, added, removed in self.get_index(dir).rescan(dir,
+            get_scan_rules(dir), include_hidden = col == self.read_only_col,
+            max_depth = scan_depth.get(dir)):
+            
+            rows = []
+            for entry in added:
+                self.forget_fingerprint(entry.path)
+                self.hidden_copies.discard(entry.path)
+                self.index_entry(col, entry)
+                # the rows past the page end come with the next pages
+                if self.in_window(col, entry):
+                    rows.append(self.make_file_row(entry))
+            yield rows, removed
+            
+    def file_pages(self, col):
+        """Yield the rows of the images indexed under the roots of a
+        tab, page_size at a time newest first, from the page end on.
+        
+        The page end is the (mtime, path) of the last row paged in, ()
+        before the first page and None once every row is in."""
+        
+        while self.page_end[col] is not None:
+            entries = self.get_page(col, self.page_end[col] or None,
+                page_size)
+            if len(entries) < page_size:
+                self.page_end[col] = None
+            else:
+                self.page_end[col] = (entries[-1].mtime, entries[-1].path)
+            yield [self.make_file_row(entry) for entry in entries]
+            
+    def load_next_page(self, col):
+        """Add the next page of rows to a tab"""
         
-        for path, dirnames, filenames in os.walk(dir, True):
-
-            if dir == '/home/olpc' :
-                f = open('olpc.files','r')
-                for line in f:
-                    line = line.strip()
-                    if line in dirnames:
-                        dirnames.remove(line)
-                f.close()
+        try:
+            rows = next(self.pages[col])
+        except StopIteration:
+            self.pages[col] = None
+            return
+            
+        self.window[col] += page_size
+        for row in rows:
+            # the rows kept through a filter change keep their thumbnail
+            if row[COLUMN_JOBJECT].get_object_id() in self.rows[col]:
+                continue
+            self.add_row(col, row)
+        self.queue_load_visible(col)
+        
+    def in_window(self, col, entry):
+        """Whether the IndexEntry entry falls in the part of a tab
+        already paged in"""
+        
+        # a filtered tab only follows the matches it shows, the others
+        # are found in the search index when the filter changes
+        if self.filters[col]:
+            return entry.path in self.rows[col]
+        end = self.page_end[col]
+        if end is None: return True
+        if not end: return False
+        return (-entry.mtime, entry.path) <= (-end[0], end[1])
+        
+    def index_entry(self, col, entry):
+        
+        self.search[col].add(entry.path, entry, entry.name, entry.path)
+            
+    def start_watching(self, col):
+        """Follow changes below the roots of a file tab"""
+        
+        from watcher import DirectoryWatcher
+        
+        self.watchers[col] = DirectoryWatcher(self._directories_changed_cb,
+            col)
+        for dir in self.roots[col]:
+            for path in self.get_index(dir).get_directories(dir):
+                self.watchers[col].watch(path)
                 
-            else:
-                f = open('media.files','r')
-                for line in f:
-                    line = line.strip()
-                    if line in dirnames:
-                        dirnames.remove(line)
-                f.close()
+    def stop_watching(self):
+        
+        for watcher in self.watchers:
+            if watcher is not None:
+                watcher.stop()
                 
-            for filename in filenames:
-                file_name = os.path.join(path, filename)
-                #remove hidden file_nameexcept for readonly
-                pos = str.find(file_name, '/.')
-                if col == 3: pos = -1
-                name = str.find(file_name, 'Cache')
+    def _directories_changed_cb(self, directories, col):
+        
+        for directory in directories:
+            roots = [dir for dir in self.roots[col]
+                if directory == dir or directory.startswith(dir + '/')]
+            if not roots: continue
+            dir = max(roots, key = len)
+            
+            for path, added, removed in self.get_index(dir).refresh(dir,
+                directory, get_scan_rules(dir),
+                include_hidden = col == self.read_only_col,
+                max_depth = scan_depth.get(dir)):
                 
-                if ((pos == -1) or name > 0) and not( os.path.islink(file_name)):
-                    if self.num > max_file: return
-                    try:
-                        file_mimetype = mime.get_for_file(os.path.join(path,filename))
-                        if (file_mimetype.startswith('image/')) :
-                            #or (file_mimetype.startswith('video/')):
-                            #check for new files
-                            self.num += 1
-                            mtime = os.path.getmtime(file_name)
-                            iter = self.ls_journal[col].append()
-                            jobject_wrapper = JobjectWrapper()
-                            jobject_wrapper.set_file_path(os.path.join(path, filename))
-                            jobject_wrapper.set_object_id(file_name)
-                            jobject_wrapper.set_title(filename)
-                            jobject_wrapper.set_mime_type(file_mimetype)
-                            jobject_wrapper.set_timestamp(mtime)
-                            jobject_wrapper.set_description(file_name)
-                            self.ls_journal[col].set(iter, COLUMN_TITLE, filename)
-                            self.ls_journal[col].set(iter, COLUMN_MTIME, str(mtime))
-                            self.ls_journal[col].set(iter, COLUMN_JOBJECT, jobject_wrapper)
-                    except IOError: print 'No mimetype for : %s' % (file_name)
+                if os.path.isdir(path):
+                    self.watchers[col].watch(path)
+                for key in removed:
+                    self.thumb_cache.invalidate(key)
+                    self.forget_fingerprint(key)
+                    self.remove_row(col, key)
+                for entry in added:
+                    self.forget_fingerprint(entry.path)
+                    self.hidden_copies.discard(entry.path)
+                    self.index_entry(col, entry)
+                    if self.in_window(col, entry):
+                        self.add_row(col, self.make_file_row(entry))
                     
+        self.queue_load_visible(col)
+        
+    def _journal_created_cb(self, sender, object_id = None, **kwargs):
+        
+        self.queue_journal_change(object_id, 'created')
+        
+    def _journal_updated_cb(self, sender, object_id = None, **kwargs):
+        
+        self.queue_journal_change(object_id, 'updated')
+        
+    def _journal_deleted_cb(self, sender, object_id = None, **kwargs):
+        
+        self.queue_journal_change(object_id, 'deleted')
+        
+    def queue_journal_change(self, object_id, change):
+        """Collect datastore changes and apply them together once the
+        burst is over"""
+        
+        if object_id is None or 0 not in self.loaded: return
+        if self.journal_changes.get(object_id) == 'created' and \
+            change == 'updated':
+            change = 'created'
+        self.journal_changes[object_id] = change
+        
+        if self.journal_changes_id is not None:
+            GLib.source_remove(self.journal_changes_id)
+        self.journal_changes_id = GLib.timeout_add(journal_refresh_delay,
+            self._journal_changes_cb)
+            
+    def _journal_changes_cb(self):
+        
+        # try again once the search index is there
+        if self.scan_index is None: return True
+        self.journal_changes_id = None
+        changes = self.journal_changes
+        self.journal_changes = {}
+        
+        for object_id, change in changes.items():
+            if change == 'deleted':
+                self.remove_row(0, object_id)
+                self.forget_fingerprint(get_journal_path(
+                    env.get_profile_path(), object_id))
+                continue
+                
+            try:
+                with stats.span('datastore.get'):
+                    ds_object = datastore.get(object_id)
+            except Exception:
+                _logger.debug('Cannot get Journal entry %s', object_id)
+                self.remove_row(0, object_id)
+                continue
+                
+            mime = ds_object.metadata.get('mime_type', '')
+            if not mime.startswith('image/') and \
+                not mime.startswith('video/'):
+                self.remove_row(0, object_id)
+                continue
+                
+            path = get_journal_file(env.get_profile_path(), object_id)
+            if path is not None:
+                self.forget_fingerprint(path)
+            self.index_journal_entry(ds_object)
+            if change == 'created' and not self.filters[0]:
+                # new entries are the newest ones
+                self.add_row(0, self.make_journal_row(ds_object), 0)
+            elif object_id in self.rows[0] or \
+                (self.pages[0] is None and not self.filters[0]):
+                # the others come with their page if not paged in yet
+                self.add_row(0, self.make_journal_row(ds_object))
+                
+        self.queue_load_visible(0)
+        return False
+        
     def load_journal_table(self, col):
+        """Fill the Journal tab with its first page of entries, newest
+        first, once the main loop is idle"""
         
-        ds_mounts = get_mounts()
-        mountpoint_id = None
-        
-        query = {}
-        if mountpoint_id is not None:
-            query['mountpoints'] = [ mountpoint_id ]
-            ds_objects, num_objects = datastore.find(query, properties = ['uid','timestamp',
-            'title', 'mime_type', 'description'], sorting = '-timestamp')
-            
-            self.ls_journal[col].clear()
-            for i in xrange (0, num_objects, 1):
-                mime = ds_objects[i].metadata['mime_type']
-            
-                if mime.startswith('image/') or	mime.startswith('video/') :
-                    iter = self.ls_journal[col].append()
-                    title = ds_objects[i].metadata['title']
-                    self.ls_journal[col].set(iter, COLUMN_TITLE, title)
-                    jobject_wrapper = JobjectWrapper()
-                    jobject_wrapper.set_jobject(ds_objects[i])
-                    jobject_wrapper.set_mime_type(mime)
-                    mtime = ds_objects[i].metadata.get('timestamp')
-                    jobject_wrapper.set_timestamp(mtime)
-                    desc = ds_objects[i].metadata.get('description')
-                    jobject_wrapper.set_description(desc)
-                    title = ds_objects[i].metadata.get('uid')
-                    jobject_wrapper.set_title(title)
-                    self.ls_journal[col].set(iter, COLUMN_MTIME, mtime)
-                    self.ls_journal[col].set(iter, COLUMN_JOBJECT, jobject_wrapper)
-                    size = self.get_size(ds_objects[i]) / 1024
-        # FIXME: object has no attribute SORT_DESCENDING
-        #self.ls_journal[col].set_sort_column_id(COLUMN_MTIME,  Gtk.SORT_DESCENDING)
-        
-    def get_size(self, jobject):
-        """Return the file size for a Journal object."""
-        
-        logging.debug('get_file_size %r', jobject.object_id)
-        path = jobject.get_file_path()
-        
-        if not path:
-            return 0
-        
-        return os.stat(path).st_size
-    
-    def show_image(self, filename, col = -1, id = 0):
+        self.clear_tab(col)
+        self.pages[col] = self.journal_pages(col)
+        self.scan_id[col] = GLib.idle_add(self._first_page_cb, col)
+        
+    def _first_page_cb(self, col):
+        
+        self.load_next_page(col)
+        # the whole Journal goes into the search index, not only the
+        # pages shown
+        self.scans[col] = self.journal_index_chunks()
+        self.scan_id[col] = GLib.idle_add(self._journal_index_step_cb, col)
+        return False
+        
+    def _journal_index_step_cb(self, col):
+        
+        try:
+            next(self.scans[col])
+        except StopIteration:
+            self.scans[col] = None
+            self.scan_id[col] = None
+            self.tab_loaded(col)
+            return False
+        return True
+        
+    def journal_index_chunks(self):
+        """Fill the search index of the Journal with the metadata of all
+        its images, one datastore.find page per step"""
+        
+        offset = 0
+        while True:
+            with stats.span('datastore.find'):
+                ds_objects, num_objects = datastore.find({},
+                    sorting = '-timestamp', limit = journal_index_page_size,
+                    offset = offset, properties = ['uid', 'timestamp',
+                    'title', 'mime_type', 'description', 'filesize'])
+                    
+            for ds_object in ds_objects:
+                mime = ds_object.metadata.get('mime_type', '')
+                # keep the entries paged in along with their preview
+                if ds_object.object_id not in self.search[0] and \
+                    (mime.startswith('image/') or mime.startswith('video/')):
+                    self.index_journal_entry(ds_object)
+            yield
+            
+            offset += len(ds_objects)
+            if not ds_objects or offset >= num_objects: break
+            
+    def journal_pages(self, col):
+        """Yield the rows of the Journal images, one datastore.find
+        page at a time; pages without images are skipped, so that a
+        Journal holding few images still fills its tab"""
+        
+        offset = 0
+        while True:
+            with stats.span('datastore.find'):
+                ds_objects, num_objects = datastore.find({},
+                    sorting = '-timestamp', limit = journal_page_size,
+                    offset = offset, properties = ['uid', 'timestamp',
+                    'title', 'mime_type', 'description', 'filesize',
+                    'preview'])
+                
+            rows = []
+            for ds_object in ds_objects:
+                mime = ds_object.metadata.get('mime_type', '')
+                if mime.startswith('image/') or mime.startswith('video/'):
+                    self.index_journal_entry(ds_object)
+                    rows.append(self.make_journal_row(ds_object))
+            if rows: yield rows
+            
+            offset += len(ds_objects)
+            if not ds_objects or offset >= num_objects: break
+            
+    def index_journal_entry(self, ds_object):
+        
+        metadata = ds_object.metadata
+        self.search[0].add(metadata.get('uid'), ds_object,
+            metadata.get('title'), metadata.get('description'))
+        
+    def make_journal_row(self, ds_object):
+        
+        title = ds_object.metadata['title']
+        jobject_wrapper = JobjectWrapper()
+        jobject_wrapper.set_jobject(ds_object)
+        jobject_wrapper.set_mime_type(ds_object.metadata['mime_type'])
+        mtime = ds_object.metadata.get('timestamp')
+        jobject_wrapper.set_timestamp(mtime)
+        desc = ds_object.metadata.get('description')
+        jobject_wrapper.set_description(desc)
+        try:
+            size = int(ds_object.metadata.get('filesize') or 0)
+        except ValueError:
+            size = 0
+        return [title, size, get_timestamp(ds_object.metadata),
+            jobject_wrapper, None]
+        
+    def show_image(self, filename, col = -1, key = None):
         """display a resized image in a preview"""
         
         try:
             if filename == None:return
             if col == -1:
-                scaled_buf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename,
+                scaled_buf = load_scaled(filename,
                     style.zoom(930), style.zoom(700))
                 return scaled_buf
             else:
-                scaled_buf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename,
-                    style.zoom(320), style.zoom(240))
-                self.image[col][id].set_from_pixbuf(scaled_buf)
-                self.image[col][id].show()
+                self.set_placeholder(col, key)
+                content = self.get_content(filename)
+                copies = []
+                if content is not None:
+                    scaled_buf = self.pixbuf_budget.get_shared(content)
+                    if scaled_buf is not None:
+                        stats.count('thumbnails_shared')
+                        self.set_thumbnail(col, key, scaled_buf, content)
+                        return
+                    copies = self.scan_index.get_copies(content)
+                self.decode_pool.submit(self.thumb_cache.get_thumbnail,
+                    (filename, copies), self._thumbnail_decoded_cb, filename,
+                    col, key, content)
         except IOError: print 'Failed to open image %s' % (filename)
         #except GError: print 'Failed zoom image %s' % (filename)
         
-class JobjectWrapper():
+    def get_content(self, filename):
+        """Return the full fingerprint of filename if one was taken of
+        the file as it is now. Otherwise return None and have the file
+        fingerprinted meanwhile, its thumbnail being shared once that
+        is done"""
+        
+        if filename in self.contents:
+            return self.contents[filename]
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        fingerprint = self.scan_index.get_fingerprint(filename, st.st_mtime,
+            st.st_size)
+        if fingerprint is None:
+            from fingerprint import fingerprint_file
+            self.hash_pool.submit(fingerprint_file, (filename,),
+                self._fingerprinted_cb, filename)
+            return None
+        return fingerprint[1]
+        
+    def forget_fingerprint(self, path):
+        
+        self.scan_index.remove_fingerprint(path)
+        self.contents.pop(path, None)
+        
+    def _fingerprinted_cb(self, fingerprint, filename):
+        
+        from fingerprint import fingerprint_file
+        
+        if fingerprint is None: return
+        mtime, size, partial, content = fingerprint
+        self.scan_index.set_fingerprint(filename, mtime, size, partial,
+            content)
+        if content is None:
+            collisions = self.scan_index.get_collisions(filename, partial)
+            if collisions:
+                # only the whole content tells these files apart
+                for path in [filename] + [path for path, full in collisions
+                    if full is None]:
+                    self.hash_pool.submit(fingerprint_file, (path, True),
+                        self._fingerprinted_cb, path)
+            return
+            
+        self.contents[filename] = content
+        self.share_thumbnails(filename, content)
+        self.hide_copies(content)
+        
+    def share_thumbnails(self, filename, content):
+        """Have the rows of filename in the file tabs hold the pixbuf of
+        its content, so a copy shown later needs no decode"""
+        
+        for col in range(1, len(self.ls_journal)):
+            iter = self.rows[col].get(filename)
+            if iter is None or filename not in self.requested[col]: continue
+            scaled_buf = self.pixbuf_budget.get_shared(content)
+            if scaled_buf is None:
+                scaled_buf = self.ls_journal[col].get_value(iter,
+                    COLUMN_PIXBUF)
+                if scaled_buf is None or scaled_buf is self.placeholder:
+                    continue
+            self.set_thumbnail(col, filename, scaled_buf, content)
+        
+    def hide_copies(self, content):
+        """Take the copies of content off the file tabs if duplicates
+        are hidden, but for the first one shown"""
+        
+        if not hide_duplicates: return
+        paths = [path for path, mtime, size in
+            self.scan_index.get_copies(content)]
+        for path in self.get_shown_copies(paths)[1:]:
+            self.hidden_copies.add(path)
+            for col in range(1, len(self.ls_journal)):
+                self.remove_row(col, path)
+                
+    def get_shown_copies(self, paths):
+        """Return the paths that exist under a root shown in the tabs;
+        the copies on a volume taken out, or deleted, keep none of the
+        others hidden"""
+        
+        return [path for path in paths if os.path.isfile(path) and
+            any(path.startswith(root + '/') for root in self.shown_roots)]
+        
+    def set_placeholder(self, col, key):
+        """show a generic image icon until the thumbnail is decoded"""
+        
+        self.set_thumbnail(col, key, self.placeholder)
+        
+    def set_thumbnail(self, col, key, scaled_buf, share = None):
+        
+        # the row may have been deleted, or its thumbnail evicted, while
+        # decoding
+        iter = self.rows[col].get(key)
+        if iter is None or key not in self.requested[col]: return
+        self.ls_journal[col].set_value(iter, COLUMN_PIXBUF, scaled_buf)
+        
+        if scaled_buf is None or scaled_buf is self.placeholder:
+            self.pixbuf_budget.remove((col, key))
+        else:
+            stats.mark('first_thumbnail')
+            self.pixbuf_budget.add((col, key), scaled_buf, share)
+            self.enforce_budget()
+            
+    def enforce_budget(self):
+        """Drop the least recently seen thumbnails, keeping the ones in
+        view, until the grids fit in thumbnail_memory; they are decoded
+        again from the thumbnail cache when scrolled back into view"""
+        
+        for col, key in self.pixbuf_budget.evict(self.visible):
+            stats.count('thumbnails_evicted')
+            iter = self.rows[col].get(key)
+            if iter is not None:
+                self.ls_journal[col].set_value(iter, COLUMN_PIXBUF, None)
+            self.requested[col].discard(key)
+            
+    def _thumbnail_decoded_cb(self, scaled_buf, filename, col, key,
+        content = None):
+        
+        if scaled_buf is None:
+            print 'Failed to open image %s' % (filename)
+        if content is None:
+            content = self.contents.get(filename)
+        if content is not None and scaled_buf is not None:
+            # a copy may have been decoded meanwhile
+            scaled_buf = self.pixbuf_budget.get_shared(content) or scaled_buf
+        self.set_thumbnail(col, key, scaled_buf, content)
+        
+class FileMetadata(Mapping):
+    """Metadata of a file entry, read from the entry when looked up
+    instead of being copied into a dict"""
+    
+    __slots__ = ('_entry',)
+    
+    _FIELDS = {
+        'uid': '_object_id',
+        'title': '_title',
+        'timestamp': '_timestamp',
+        'mime_type': '_mime_type',
+        'description': '_description',
+        }
+    _EMPTY = ['activity', 'activity_id', 'icon-color']
+    
+    def __init__(self, entry):
+        
+        self._entry = entry
+        
+    def __getitem__(self, key):
+        
+        if key in self._FIELDS:
+            return getattr(self._entry, self._FIELDS[key])
+        if key in self._EMPTY:
+            return ''
+        raise KeyError(key)
+        
+    def __iter__(self):
+        
+        return iter(list(self._FIELDS.keys()) + self._EMPTY)
+        
+    def __len__(self):
+        
+        return len(self._FIELDS) + len(self._EMPTY)
+        
+    def has_key(self, key):
+        
+        return key in self
+        
+class JobjectWrapper(object):
+    """One grid entry, a Journal object or a file.
+    
+    There is one per row, so the attributes live in slots and the mime
+    types are interned rather than each entry carrying a dict."""
+    
+    __slots__ = ('_jobject', '_file_path', '_object_id', '_title',
+        '_mime_type', '_timestamp', '_description')
     
     def __init__(self):
         
-        self.__jobject = None
-        self.__file_path = None
+        self._jobject = None
+        self._file_path = None
+        self._object_id = None
+        self._title = None
+        self._mime_type = None
+        self._timestamp = None
+        self._description = None
 
     def set_jobject(self, jobject):
         
-        self.__jobject = jobject
+        self._jobject = jobject
 
     def set_file_path(self, file_path):
         
-        self.__file_path = file_path
+        self._file_path = file_path
 
     def set_title(self, filename):
         
-        if  self.__jobject != None:
-            self.__jobject.metadata['title'] = filename
+        if  self._jobject != None:
+            self._jobject.metadata['title'] = filename
         else:
-            self.__title = filename
+            self._title = filename
 
     def get_title(self):
         
-        if  self.__jobject != None:
-            return self.__jobject.metadata['title']
+        if  self._jobject != None:
+            return self._jobject.metadata['title']
         else:
-            return self.__title
+            return self._title
         
     def set_mime_type(self,mime_type):
         
-        if  self.__jobject != None:
-            self.__jobject.metadata['mime_type'] = mime_type
+        if isinstance(mime_type, str):
+            mime_type = intern(mime_type)
+        if  self._jobject != None:
+            self._jobject.metadata['mime_type'] = mime_type
         else:
-            self.__mime_type = mime_type
+            self._mime_type = mime_type
             
     def set_timestamp(self, time):
         
-        if  self.__jobject != None:
-            self.__jobject.metadata['timestamp'] = time
+        if  self._jobject != None:
+            self._jobject.metadata['timestamp'] = time
         else:
-            self.__timestamp = time
+            self._timestamp = time
 
     def set_description(self, desc):
         
-        if  self.__jobject != None:
-            self.__jobject.metadata['description'] = desc
+        if  self._jobject != None:
+            self._jobject.metadata['description'] = desc
         else:
-            self.__description = desc
+            self._description = desc
 
     def set_object_id(self,id):
         
-        self.__object_id=id
+        self._object_id=id
 
     def get_file_path(self):
         
-        if  self.__jobject != None:
-            return self.__jobject.get_file_path()
+        if  self._jobject != None:
+            return self._jobject.get_file_path()
         else:
-            return self.__file_path
+            return self._file_path
         
     def get_timestamp(self):
         
-        if self.__jobject != None:
+        if self._jobject != None:
             # may cause error
-            return self.__jobject.metadata.get('timestamp')
+            return self._jobject.metadata.get('timestamp')
         else:
-            return self.__timestamp
+            return self._timestamp
         
     def get_file_metadata(self):
         
-        if self.__jobject != None:
+        if self._jobject != None:
             # may cause error
-            return self.__jobject.metadata
+            return self._jobject.metadata
         else:
-            #client = gconf.client_get_default()
-            path = self.__file_path
-            return {
-                'uid': self.__object_id,
-                'title': self.__title,
-                'timestamp': self.__timestamp,
-                'mime_type': self.__mime_type,
-                'activity': '',
-                'activity_id': '',
-                'icon-color': '',
-                'description': self.__description
-                }
+            return FileMetadata(self)
                 
     def get_mime_type(self):
         
-        if self.__jobject != None:
-            return self.__jobject.metadata['mimetype']
+        if self._jobject != None:
+            return self._jobject.metadata['mime_type']
         else:
-            return self.__mime_type
+            return self._mime_type
 
     def get_object_id(self):
         
-        if self.__jobject != None:
-            return self.__jobject.object_id
+        if self._jobject != None:
+            return self._jobject.object_id
         else:
-            return self.__object_id
-        
\ No newline at end of file
+            return self._object_id
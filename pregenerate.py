@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# pregenerate.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Fill the thumbnail cache of the activity without starting it.
+
+    python pregenerate.py [--workers N] [--no-journal] [--no-mounts]
+
+The roots the activity shows are scanned with the same exclusion rules
+(olpc.files for the home directory, media.files for the others) through
+the activity's scan indexes, the one of each mounted volume included,
+and the Journal images that have no preview are added. Thumbnails are
+made by a pool of processes at the grid size and written into the
+activity's thumbnail cache. Thumbnails already in the cache and up to
+date are skipped, so an interrupted run picks up where it stopped when
+started again.
+
+When the images would not all fit in the thumbnail cache, only the
+newest ones are made, the ones the tabs show first; the cache would
+otherwise evict the thumbnails made early in the run. A warning tells
+how big --cache-size (and IMAGETHUMBNAIL_CACHE_MB for the activity)
+would have to be.
+"""
+
+import os
+import sys
+import logging
+import argparse
+import multiprocessing
+
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+
+from sugar3 import env
+from sugar3.graphics import style
+
+import stats
+from thumbcache import ThumbnailCache
+from decoder import get_default_workers
+from decoder import load_scaled
+from scanner import HOME
+from scanner import get_journal_file
+from scanner import get_mounts
+from scanner import get_read_only_roots
+from scanner import get_scan_rules
+from scanindex import ScanIndex
+from volumes import open_volume_index
+
+_logger = logging.getLogger('image-thumbnail')
+
+BUNDLE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Journal entries fetched by each datastore.find call
+JOURNAL_PAGE_SIZE = 200
+# thumbnails handed to a worker process at a time
+CHUNK_SIZE = 16
+# bytes a thumbnail is expected to take in the cache when it has none
+# to measure yet
+THUMBNAIL_BYTES = 150 * 1024
+
+CACHED = 'cached'
+MADE = 'made'
+FAILED = 'failed'
+
+_cache = None
+
+
+def get_activity_root():
+    """Return the data root the activity gets from sugar"""
+
+    if os.environ.get('SUGAR_ACTIVITY_ROOT'):
+        return os.environ['SUGAR_ACTIVITY_ROOT']
+
+    info = ConfigParser()
+    info.read(os.path.join(BUNDLE_DIR, 'activity', 'activity.info'))
+    return env.get_profile_path(info.get('Activity', 'bundle_id'))
+
+
+def get_roots():
+    """Return (root, include_hidden) for the roots of the file tabs
+    other than the mounted volumes"""
+
+    roots = [(HOME, False)]
+    # hidden files are only shown in the Read Only tab
+    roots.extend((root, True) for root in get_read_only_roots())
+    return roots
+
+
+def list_files(scan_index, root, include_hidden):
+    """Bring the scan index of root up to date and return (mtime, path)
+    for its images"""
+
+    for directory, added, removed in scan_index.rescan(root,
+        get_scan_rules(root), include_hidden):
+        pass
+    return [(entry.mtime, entry.path) for entry in scan_index.get_files(root)]
+
+
+def list_journal_files():
+    """Return (mtime, path) for the files of the Journal images shown
+    without a preview"""
+
+    from sugar3.datastore import datastore
+
+    profile_path = env.get_profile_path()
+    paths = []
+    offset = 0
+    while True:
+        ds_objects, num_objects = datastore.find({},
+            limit = JOURNAL_PAGE_SIZE, offset = offset,
+            properties = ['uid', 'mime_type', 'preview'])
+        for ds_object in ds_objects:
+            metadata = ds_object.metadata
+            if not metadata.get('mime_type', '').startswith('image/'):
+                continue
+            if metadata.get('preview') not in [None, '', 'None']:
+                continue
+            path = get_journal_file(profile_path, metadata['uid'])
+            if path is not None:
+                paths.append((os.path.getmtime(path), path))
+
+        offset += len(ds_objects)
+        if not ds_objects or offset >= num_objects:
+            break
+    return paths
+
+
+def get_thumbnail_bytes(directory):
+    """Return the average size of the thumbnails in directory, or
+    THUMBNAIL_BYTES if there are too few to tell"""
+
+    sizes = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.png'):
+                sizes.append(os.path.getsize(os.path.join(directory, name)))
+    if len(sizes) < 10:
+        return THUMBNAIL_BYTES
+    return sum(sizes) // len(sizes)
+
+
+def _init_worker(directory, width, height, max_bytes):
+
+    global _cache
+    _cache = ThumbnailCache(directory, width, height, max_bytes)
+
+
+def make_thumbnail(path):
+    """Return (path, status) once the thumbnail of path is in the cache"""
+
+    try:
+        st = os.stat(path)
+        if _cache.lookup(path, st.st_mtime, st.st_size) is not None:
+            return path, CACHED
+        pixbuf = load_scaled(path, _cache.width, _cache.height)
+        _cache.store(path, pixbuf, st.st_mtime, st.st_size)
+        return path, MADE
+    except Exception:
+        _logger.debug('Cannot make a thumbnail for %s', path, exc_info = True)
+        return path, FAILED
+
+
+def report(counts, total, last = False):
+
+    done = sum(counts.values())
+    line = '%d/%d thumbnails, %d made, %d cached, %d failed' % (done, total,
+        counts[MADE], counts[CACHED], counts[FAILED])
+    if sys.stdout.isatty():
+        sys.stdout.write('\r' + line + ('\n' if last else ''))
+    elif last or done % 100 == 0:
+        sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Generate the '
+        'thumbnails of the Image Thumbnail activity ahead of time.')
+    parser.add_argument('--workers', type = int, default = 0,
+        help = 'worker processes, one per core by default')
+    parser.add_argument('--activity-root', default = None,
+        help = 'data root of the activity, found from the sugar profile '
+        'by default')
+    parser.add_argument('--cache-size', type = int,
+        default = int(os.environ.get('IMAGETHUMBNAIL_CACHE_MB', '0')),
+        help = 'megabytes the thumbnail cache may use, by default what '
+        'the activity uses')
+    parser.add_argument('--no-journal', action = 'store_true',
+        help = 'skip the Journal images')
+    parser.add_argument('--no-mounts', action = 'store_true',
+        help = 'skip the mounted media')
+    parser.add_argument('--verbose', action = 'store_true',
+        help = 'log the files that cannot be read')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose
+        else logging.WARNING)
+    activity_root = os.path.abspath(args.activity_root or
+        get_activity_root())
+    # the exclusion lists are read relative to the bundle
+    os.chdir(BUNDLE_DIR)
+
+    width, height = style.zoom(320), style.zoom(240)
+    directory = os.path.join(activity_root, 'data', 'thumbnails')
+    cache = ThumbnailCache(directory, width, height,
+        args.cache_size * 1024 * 1024 or None)
+    max_bytes = cache.max_bytes
+
+    scan_index = ScanIndex(os.path.join(activity_root, 'data',
+        'scan-index.db'))
+
+    paths = []
+    seen = set()
+
+    def add_files(scan_index, root, include_hidden):
+
+        sys.stdout.write('Scanning %s\n' % root)
+        for mtime, path in list_files(scan_index, root, include_hidden):
+            if path not in seen:
+                seen.add(path)
+                paths.append((mtime, path))
+
+    try:
+        for root, include_hidden in get_roots():
+            add_files(scan_index, root, include_hidden)
+
+        if not args.no_mounts:
+            # the thumbnails and fingerprints of a volume mounted
+            # somewhere else than last time move with its index
+            for mount in get_mounts():
+                volume_index = open_volume_index(os.path.join(activity_root,
+                    'data', 'volumes'), mount, cache, scan_index)
+                try:
+                    add_files(volume_index, mount['mount_path'], False)
+                finally:
+                    volume_index.close()
+    finally:
+        scan_index.close()
+
+    if not args.no_journal:
+        sys.stdout.write('Listing the Journal\n')
+        try:
+            paths.extend(list_journal_files())
+        except Exception:
+            _logger.warning('Cannot list the Journal', exc_info = True)
+
+    # the cache evicts down to 90% of its budget
+    thumbnail_bytes = get_thumbnail_bytes(cache.directory)
+    fit = max_bytes * 9 // 10 // thumbnail_bytes
+    paths.sort(reverse = True)
+    if len(paths) > fit:
+        needed = len(paths) * thumbnail_bytes * 10 // 9 // (1024 * 1024) + 1
+        sys.stdout.write('Warning: the %d MB cache holds about %d of the '
+            '%d thumbnails, only the newest are made; use --cache-size %d '
+            'and IMAGETHUMBNAIL_CACHE_MB=%d for all of them\n' %
+            (max_bytes // (1024 * 1024), fit, len(paths), needed, needed))
+        del paths[fit:]
+    paths = [path for mtime, path in paths]
+
+    pool = multiprocessing.Pool(args.workers or get_default_workers(),
+        _init_worker, (directory, width, height, max_bytes))
+
+    counts = {MADE: 0, CACHED: 0, FAILED: 0}
+    try:
+        for path, status in pool.imap_unordered(make_thumbnail, paths,
+            CHUNK_SIZE):
+            counts[status] += 1
+            report(counts, len(paths))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        report(counts, len(paths), True)
+        sys.stdout.write('Interrupted, run again to resume\n')
+        return 1
+    pool.join()
+
+    report(counts, len(paths), True)
+    stats.dump()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+# scanindex.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Persistent index of the images found under each scanned root.
+
+The index remembers every image (path, mtime, size, mime type and
+thumbnail name) and the mtime of every directory visited. The images
+of a root can be listed straight from the index at startup; a rescan
+then only lists the directories whose mtime changed, since adding,
+removing or renaming an entry is what changes a directory mtime.
+
+The content fingerprints of the images (see fingerprint.py) are kept
+by path next to them, and dropped when an image changes or goes away.
+"""
+
+import os
+import logging
+import sqlite3
+from collections import namedtuple
+
+import stats
+from scanner import get_mime_type
+from scanner import is_image
+from scanner import scan_directory
+from thumbcache import get_thumbnail_name
+
+_logger = logging.getLogger('image-thumbnail')
+
+# changed directories written between two commits during a rescan
+COMMIT_INTERVAL = 100
+
+IndexEntry = namedtuple('IndexEntry',
+    ['path', 'name', 'mtime', 'size', 'mime_type', 'thumbnail'])
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS directories ('
+        'root TEXT, path TEXT, parent TEXT, mtime REAL, '
+        'PRIMARY KEY (root, path))',
+    'CREATE INDEX IF NOT EXISTS directories_parent '
+        'ON directories (root, parent)',
+    'CREATE TABLE IF NOT EXISTS files ('
+        'root TEXT, path TEXT, directory TEXT, name TEXT, mtime REAL, '
+        'size INTEGER, mime_type TEXT, thumbnail TEXT, '
+        'PRIMARY KEY (root, path))',
+    'CREATE INDEX IF NOT EXISTS files_directory ON files (root, directory)',
+    'DROP INDEX IF EXISTS files_path',
+    'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime DESC, path)',
+    'CREATE TABLE IF NOT EXISTS fingerprints ('
+        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, partial TEXT, '
+        'full TEXT, found INTEGER)',
+    'CREATE INDEX IF NOT EXISTS fingerprints_partial '
+        'ON fingerprints (partial)',
+    'CREATE INDEX IF NOT EXISTS fingerprints_full ON fingerprints (full)',
+]
+
+# run once the tables exist, for indexes made before found was added
+_FINGERPRINTS_FOUND = [
+    'ALTER TABLE fingerprints ADD COLUMN found INTEGER',
+    'UPDATE fingerprints SET found = rowid',
+]
+
+
+def _subtree(path):
+    """Return the bounds of the paths strictly below path"""
+
+    # '0' is the character right after '/'
+    return path + '/', path + '0'
+
+
+class ScanIndex(object):
+
+    def __init__(self, filename):
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._db = sqlite3.connect(filename)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        columns = [row[1] for row in
+            self._db.execute('PRAGMA table_info(fingerprints)')]
+        if 'found' not in columns:
+            for statement in _FINGERPRINTS_FOUND:
+                self._db.execute(statement)
+        self._db.execute('CREATE INDEX IF NOT EXISTS fingerprints_found '
+            'ON fingerprints (found)')
+        self._db.commit()
+
+    def close(self):
+
+        self._db.commit()
+        self._db.close()
+
+    def get_files(self, root):
+        """Return the IndexEntry of every image indexed under root"""
+
+        cursor = self._db.execute('SELECT path, name, mtime, size, '
+            'mime_type, thumbnail FROM files WHERE root = ?', (root,))
+        return [IndexEntry(*row) for row in cursor]
+
+    def get_page(self, roots, after, limit):
+        """Return the IndexEntry of at most limit images indexed under
+        roots, newest first and by path among equals, starting past the
+        (mtime, path) after, or from the newest if after is None"""
+
+        where = 'root IN (%s)' % ', '.join('?' * len(roots))
+        params = list(roots)
+        if after is not None:
+            where += ' AND (mtime < ? OR (mtime = ? AND path > ?))'
+            params.extend([after[0], after[0], after[1]])
+        cursor = self._db.execute('SELECT DISTINCT path, name, mtime, size, '
+            'mime_type, thumbnail FROM files WHERE %s '
+            'ORDER BY mtime DESC, path LIMIT ?' % where, params + [limit])
+        return [IndexEntry(*row) for row in cursor]
+
+    def rescan(self, root, rules = None, include_hidden = False,
+        max_depth = None, commit_interval = COMMIT_INTERVAL):
+        """Bring the index of root up to date.
+
+        Yields (directory, added, removed) for every directory visited:
+        added are the IndexEntry of new or modified images and removed
+        the paths of images that went away. Directories whose mtime did
+        not change are not listed and yield nothing added or removed.
+
+        The changes are committed every commit_interval changed
+        directories; a rescan on a thread of its own commits each one,
+        so the writes of the main loop do not wait on it.
+        """
+
+        changed = 0
+        stack = [(root, 0, '/.' in root)]
+        while stack:
+            path, depth, hidden = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+
+            if self._get_directory_mtime(root, path) == mtime:
+                stats.count('directories_unchanged')
+                added = []
+                removed = []
+                subdirs = self._get_subdirectories(root, path)
+            else:
+                try:
+                    files, entries = scan_directory(path, hidden, rules,
+                        include_hidden)
+                except OSError:
+                    continue
+
+                subdirs = [entry.path for entry in entries]
+                added, removed = self._update_files(root, path, files)
+                removed.extend(self._update_directory(root, path, mtime,
+                    subdirs))
+                stats.count('directories_scanned')
+                stats.count('images_found', len(added))
+                changed += 1
+                if changed % commit_interval == 0:
+                    self._db.commit()
+
+            yield path, added, removed
+
+            if max_depth is None or depth < max_depth:
+                for subdir in reversed(subdirs):
+                    stack.append((subdir, depth + 1,
+                        hidden or os.path.basename(subdir).startswith('.')))
+        self._db.commit()
+
+    def refresh(self, root, directory, rules = None, include_hidden = False,
+        max_depth = None):
+        """Relist directory, which must be root or below it, after a
+        change notification.
+
+        Unlike rescan the directory mtime is not trusted and the known
+        subdirectories are not visited; only subdirectories new to the
+        index are scanned. Yields (directory, added, removed) like
+        rescan.
+        """
+
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+                files, entries = scan_directory(path, '/.' in path, rules,
+                    include_hidden)
+            except OSError:
+                # the directory itself went away
+                yield path, [], self.remove_tree(root, path)
+                continue
+
+            known = set(self._get_subdirectories(root, path))
+            subdirs = [entry.path for entry in entries]
+            added, removed = self._update_files(root, path, files)
+            removed.extend(self._update_directory(root, path, mtime,
+                subdirs))
+            yield path, added, removed
+
+            depth = path[len(root):].count('/')
+            if max_depth is None or depth < max_depth:
+                for subdir in subdirs:
+                    if subdir not in known:
+                        stack.append(subdir)
+        self._db.commit()
+
+    def get_fingerprint(self, path, mtime, size):
+        """Return the (partial, full) fingerprint of path, or None if it
+        was not taken of the file with that mtime and size"""
+
+        return self._db.execute('SELECT partial, full FROM fingerprints '
+            'WHERE path = ? AND mtime = ? AND size = ?',
+            (path, mtime, size)).fetchone()
+
+    def set_fingerprint(self, path, mtime, size, partial, full = None):
+        """Record the fingerprint of path; a path fingerprinted again,
+        with its full fingerprint for instance, keeps its place in the
+        order of get_copies"""
+
+        self._db.execute('INSERT OR REPLACE INTO fingerprints VALUES '
+            '(?, ?, ?, ?, ?, COALESCE((SELECT found FROM fingerprints '
+            'WHERE path = ?), (SELECT IFNULL(MAX(found), 0) + 1 '
+            'FROM fingerprints)))', (path, mtime, size, partial, full, path))
+        self._db.commit()
+
+    def remove_fingerprint(self, path):
+
+        self._db.execute('DELETE FROM fingerprints WHERE path = ?', (path,))
+
+    def get_collisions(self, path, partial):
+        """Return (path, full) for the other files with the partial
+        fingerprint of path"""
+
+        cursor = self._db.execute('SELECT path, full FROM fingerprints '
+            'WHERE partial = ? AND path != ?', (partial, path))
+        return cursor.fetchall()
+
+    def get_copies(self, full):
+        """Return (path, mtime, size) for the files whose content is
+        full, in the order they were fingerprinted"""
+
+        cursor = self._db.execute('SELECT path, mtime, size FROM fingerprints '
+            'WHERE full = ? ORDER BY found', (full,))
+        return cursor.fetchall()
+
+    def get_duplicates(self):
+        """Return the paths of the files sharing their content with
+        others, a list per content in the order they were fingerprinted"""
+
+        cursor = self._db.execute('SELECT full, path FROM fingerprints '
+            'WHERE full IN (SELECT full FROM fingerprints '
+            'WHERE full IS NOT NULL GROUP BY full HAVING COUNT(*) > 1) '
+            'ORDER BY found')
+        duplicates = {}
+        for full, path in cursor:
+            duplicates.setdefault(full, []).append(path)
+        return list(duplicates.values())
+
+    def get_roots(self):
+        """Return the roots indexed"""
+
+        cursor = self._db.execute('SELECT DISTINCT root FROM directories')
+        return [row[0] for row in cursor]
+
+    def move_root(self, old, new):
+        """Move what is indexed under the root old to the root new, for
+        a volume mounted somewhere else than last time, and return
+        (old path, new path) for the images moved"""
+
+        def move(path):
+            return new + path[len(old):]
+
+        cursor = self._db.execute('SELECT path, directory FROM files '
+            'WHERE root = ?', (old,))
+        files = cursor.fetchall()
+        self._db.executemany('UPDATE files SET root = ?, path = ?, '
+            'directory = ?, thumbnail = ? WHERE root = ? AND path = ?',
+            [(new, move(path), move(directory),
+            get_thumbnail_name(move(path)), old, path)
+            for path, directory in files])
+
+        cursor = self._db.execute('SELECT path, parent FROM directories '
+            'WHERE root = ?', (old,))
+        self._db.executemany('UPDATE directories SET root = ?, path = ?, '
+            'parent = ? WHERE root = ? AND path = ?',
+            [(new, move(path), move(parent) if path != old
+            else os.path.dirname(new), old, path)
+            for path, parent in cursor.fetchall()])
+        self._db.commit()
+        return [(path, move(path)) for path, directory in files]
+
+    def move_fingerprints(self, moves):
+        """Move the fingerprints of the files moved, given as (old path,
+        new path)"""
+
+        self._db.executemany('UPDATE OR REPLACE fingerprints SET path = ? '
+            'WHERE path = ?', [(new, old) for old, new in moves])
+        self._db.commit()
+
+    def remove_files(self, root, paths):
+        """Drop the images at paths from the index of root"""
+
+        self._db.executemany('DELETE FROM files WHERE root = ? AND path = ?',
+            [(root, path) for path in paths])
+        self._db.executemany('DELETE FROM fingerprints WHERE path = ?',
+            [(path,) for path in paths])
+        self._db.commit()
+
+    def get_directories(self, root):
+        """Return the directories indexed under root"""
+
+        cursor = self._db.execute('SELECT path FROM directories '
+            'WHERE root = ?', (root,))
+        return [row[0] for row in cursor]
+
+    def _get_directory_mtime(self, root, path):
+
+        row = self._db.execute('SELECT mtime FROM directories '
+            'WHERE root = ? AND path = ?', (root, path)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _get_subdirectories(self, root, path):
+
+        cursor = self._db.execute('SELECT path FROM directories '
+            'WHERE root = ? AND parent = ?', (root, path))
+        return [row[0] for row in cursor]
+
+    def _update_files(self, root, directory, files):
+
+        cursor = self._db.execute('SELECT path, mtime, size FROM files '
+            'WHERE root = ? AND directory = ?', (root, directory))
+        old = dict((row[0], (row[1], row[2])) for row in cursor)
+
+        added = []
+        for entry in files:
+            previous = old.pop(entry.path, None)
+            try:
+                st = entry.stat()
+                if previous == (st.st_mtime, st.st_size):
+                    continue
+                mime_type = get_mime_type(entry.path, st.st_mtime)
+            except (IOError, OSError):
+                _logger.debug('No mimetype for : %s', entry.path)
+                mime_type = None
+
+            if not is_image(mime_type):
+                if previous is not None:
+                    old[entry.path] = previous
+                continue
+
+            record = IndexEntry(entry.path, entry.name, st.st_mtime,
+                st.st_size, mime_type, get_thumbnail_name(entry.path))
+            self._db.execute('INSERT OR REPLACE INTO files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?)', (root, record.path, directory,
+                record.name, record.mtime, record.size, record.mime_type,
+                record.thumbnail))
+            added.append(record)
+
+        removed = list(old.keys())
+        self._db.executemany('DELETE FROM files WHERE root = ? AND path = ?',
+            [(root, path) for path in removed])
+        self._db.executemany('DELETE FROM fingerprints WHERE path = ?',
+            [(path,) for path in removed] +
+            [(record.path,) for record in added])
+        return added, removed
+
+    def _update_directory(self, root, path, mtime, subdirs):
+        """Record the mtime and subdirectories of path and drop the
+        subdirectories that went away; returns the images removed"""
+
+        self._db.execute('INSERT OR REPLACE INTO directories VALUES '
+            '(?, ?, ?, ?)', (root, path, os.path.dirname(path), mtime))
+
+        removed = []
+        current = set(subdirs)
+        for subdir in self._get_subdirectories(root, path):
+            if subdir not in current:
+                removed.extend(self.remove_tree(root, subdir))
+        return removed
+
+    def remove_tree(self, root, path):
+        """Drop path and everything below it from the index of root,
+        returning the paths of the images removed"""
+
+        low, high = _subtree(path)
+        cursor = self._db.execute('SELECT path FROM files WHERE root = ? '
+            'AND (directory = ? OR (directory >= ? AND directory < ?))',
+            (root, path, low, high))
+        removed = [row[0] for row in cursor]
+
+        self._db.executemany('DELETE FROM fingerprints WHERE path = ?',
+            [(path,) for path in removed])
+        self._db.execute('DELETE FROM files WHERE root = ? '
+            'AND (directory = ? OR (directory >= ? AND directory < ?))',
+            (root, path, low, high))
+        self._db.execute('DELETE FROM directories WHERE root = ? '
+            'AND (path = ? OR (path >= ? AND path < ?))',
+            (root, path, low, high))
+        return removed
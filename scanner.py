@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+# scanner.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Helpers for scanning the file system for images.
+
+Directories are listed with scandir so the file type and stat result of
+each entry come from the listing itself, and the exclusion lists are
+read and compiled once per file rather than once per directory.
+
+The mime type of a file is decided from its extension whenever the
+extension is known. Only files with a missing or unknown extension are
+opened, and then only to read a few magic bytes; those results are
+remembered by (path, mtime).
+"""
+
+import os
+import re
+import stat
+import fnmatch
+import logging
+import mimetypes
+
+from gi.repository import Gio
+
+import stats
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_logger = logging.getLogger('image-thumbnail')
+
+# the root of the Files tab; the Read Only tab shows the directories
+# olpc.files excludes from it
+HOME = '/home/olpc'
+
+IMAGE_EXTENSIONS = {
+    '.bmp': 'image/bmp',
+    '.gif': 'image/gif',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.jpe': 'image/jpeg',
+    '.png': 'image/png',
+    '.tif': 'image/tiff',
+    '.tiff': 'image/tiff',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon',
+    '.xpm': 'image/x-xpixmap',
+    '.pnm': 'image/x-portable-anymap',
+    '.webp': 'image/webp',
+}
+
+MAGIC = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'BM', 'image/bmp'),
+    (8, b'WEBP', 'image/webp'),
+]
+MAGIC_SIZE = 16
+
+# sniffed mime types by (path, mtime)
+MEMO_SIZE = 100000
+_memo = {}
+
+_rules = {}
+
+
+class _DirEntry(object):
+    """Minimal os.DirEntry stand-in used when scandir is not available"""
+
+    def __init__(self, directory, name):
+
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self):
+
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self):
+
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_file(self):
+
+        return stat.S_ISREG(self.stat().st_mode)
+
+    def is_symlink(self):
+
+        return stat.S_ISLNK(self.stat().st_mode)
+
+
+def list_directory(path):
+
+    if scandir is not None:
+        return list(scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+class ExclusionRules(object):
+    """Directory names to skip, as plain names or shell patterns"""
+
+    def __init__(self, patterns):
+
+        self.names = set()
+        globs = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern:
+                continue
+            if '*' in pattern or '?' in pattern or '[' in pattern:
+                globs.append(fnmatch.translate(pattern))
+            else:
+                self.names.add(pattern)
+
+        self._glob = None
+        if globs:
+            self._glob = re.compile('|'.join(globs))
+
+    def match(self, name):
+
+        if name in self.names:
+            return True
+        return self._glob is not None and self._glob.match(name) is not None
+
+
+def get_rules(filename):
+    """Return the ExclusionRules read from filename, reading it once"""
+
+    if filename not in _rules:
+        f = open(filename, 'r')
+        try:
+            _rules[filename] = ExclusionRules(f.readlines())
+        finally:
+            f.close()
+    return _rules[filename]
+
+
+def get_scan_rules(root):
+    """Return the ExclusionRules of a scanned root"""
+
+    if root == HOME:
+        return get_rules('olpc.files')
+    else:
+        return get_rules('media.files')
+
+
+def get_read_only_roots():
+
+    f = open('olpc.files', 'r')
+    try:
+        return [os.path.join(HOME, line.strip()) for line in f
+            if line.strip()]
+    finally:
+        f.close()
+
+
+def get_volume_id(mount, path):
+    """Return what tells the volume of a mount apart across insertions:
+    its filesystem uuid, or else its name and size"""
+
+    uuid = mount.get_uuid()
+    volume = mount.get_volume()
+    if not uuid and volume is not None:
+        uuid = volume.get_identifier(Gio.VOLUME_IDENTIFIER_KIND_UUID)
+    if uuid:
+        return uuid
+
+    try:
+        st = os.statvfs(path)
+        size = st.f_blocks * st.f_frsize
+    except OSError:
+        size = 0
+    return '%s-%d' % (mount.get_name(), size)
+
+
+def get_mounts():
+
+    volume_monitor = Gio.VolumeMonitor.get()
+
+    mounts = []
+    for mount in volume_monitor.get_mounts():
+        description = {}
+        description['mount_path'] = mount.get_default_location().get_path()
+        description['label'] = mount.get_name()
+        description['volume_id'] = get_volume_id(mount,
+            description['mount_path'])
+        mounts.append(description)
+
+    return mounts
+
+
+def get_journal_path(profile_path, uid):
+    """Return where the datastore keeps the file of a Journal entry"""
+
+    return os.path.join(profile_path, 'datastore', uid[:2], uid, 'data')
+
+
+def get_journal_file(profile_path, uid):
+    """Return the file the datastore keeps for a Journal entry, or None.
+
+    Reading it in place spares the copy datastore.get_filename makes,
+    and gives the entry a path that stays the same across launches."""
+
+    path = get_journal_path(profile_path, uid)
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def scan_directory(path, hidden, rules = None, include_hidden = False):
+    """List path and return (files, subdirs).
+
+    files are the DirEntry objects of the regular files that pass the
+    filters: symbolic links and special files are skipped and, unless
+    include_hidden is set, files under a hidden name are dropped except
+    for those below a Cache directory. subdirs are the DirEntry objects
+    of the directories not matching rules. hidden tells whether path is
+    itself below a hidden name.
+    """
+
+    files = []
+    subdirs = []
+    with stats.span('list_directory'):
+        entries = list_directory(path)
+    for entry in entries:
+        try:
+            if entry.is_symlink():
+                continue
+            is_dir = entry.is_dir()
+            is_file = not is_dir and entry.is_file()
+        except OSError:
+            continue
+
+        name = entry.name
+        if is_dir:
+            if rules is None or not rules.match(name):
+                subdirs.append(entry)
+        elif not is_file:
+            continue
+        elif include_hidden or 'Cache' in entry.path or \
+            not (hidden or name.startswith('.')):
+            files.append(entry)
+
+    stats.count('entries_listed', len(entries))
+    stats.count('entries_skipped', len(entries) - len(files) - len(subdirs))
+    return files, subdirs
+
+
+def sniff_mime_type(path):
+    """Return the image mime type found in the first bytes of path,
+    or None"""
+
+    f = open(path, 'rb')
+    try:
+        head = f.read(MAGIC_SIZE)
+    finally:
+        f.close()
+
+    for offset, magic, mime_type in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+    return None
+
+
+def get_mime_type(path, mtime = None):
+    """Return the mime type of path, or None if it cannot be told.
+
+    mtime is only needed for names that have to be sniffed; it is
+    looked up when not given."""
+
+    name = os.path.basename(path)
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return IMAGE_EXTENSIONS[extension]
+
+    if extension:
+        # the system mime databases are read when first needed rather
+        # than at import, before the first frame
+        if not mimetypes.inited:
+            mimetypes.init()
+        mime_type = mimetypes.guess_type(name, strict = False)[0]
+        if mime_type is not None:
+            return mime_type
+
+    if mtime is None:
+        mtime = os.path.getmtime(path)
+    key = (path, mtime)
+    if key in _memo:
+        return _memo[key]
+
+    with stats.span('sniff_mime_type'):
+        mime_type = sniff_mime_type(path)
+    if len(_memo) >= MEMO_SIZE:
+        _memo.clear()
+    _memo[key] = mime_type
+    return mime_type
+
+
+def is_image(mime_type):
+
+    return mime_type is not None and mime_type.startswith('image/')
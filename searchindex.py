@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# searchindex.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""In-memory index for the filter box.
+
+The text of an entry (title, path, description) is split into lower
+case tokens. Every token is filed under its trigrams, and under its
+first one and two characters, so the tokens containing a word typed in
+the filter box are found from a few set intersections instead of a
+pass over every entry. An entry matches when each word of the filter
+is found in one of its tokens; words of one or two characters have to
+start the token.
+"""
+
+import re
+
+_SPLIT = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def get_tokens(text):
+
+    if not text:
+        return set()
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return set(token for token in _SPLIT.split(text.lower()) if token)
+
+
+def get_trigrams(token):
+
+    return set(token[i:i + 3] for i in range(len(token) - 2))
+
+
+class SearchIndex(object):
+    """Entries indexed by key, each with a payload kept for the caller.
+
+    search returns the keys of the matching entries in the order they
+    were first added."""
+
+    def __init__(self):
+
+        # key: (order, payload, tokens)
+        self._entries = {}
+        # order: key
+        self._order = {}
+        self._next = 0
+        # token: orders of the keys indexed under it, kept as numbers so
+        # the matches sort fast
+        self._keys = {}
+        # trigram, or first one or two characters: tokens
+        self._tokens = {}
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def __contains__(self, key):
+
+        return key in self._entries
+
+    def add(self, key, payload, *texts):
+        """Index key under texts, replacing what it was indexed under"""
+
+        tokens = set()
+        for text in texts:
+            tokens.update(get_tokens(text))
+
+        previous = self._entries.get(key)
+        if previous is None:
+            order = self._next
+            self._next += 1
+            self._order[order] = key
+            new_tokens = tokens
+        else:
+            order = previous[0]
+            self._unlink(order, previous[2] - tokens)
+            new_tokens = tokens - previous[2]
+        self._entries[key] = (order, payload, tokens)
+
+        for token in new_tokens:
+            keys = self._keys.get(token)
+            if keys is None:
+                keys = self._keys[token] = set()
+                for gram in get_trigrams(token) | set([token[:1], token[:2]]):
+                    self._tokens.setdefault(gram, set()).add(token)
+            keys.add(order)
+
+    def remove(self, key):
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            del self._order[entry[0]]
+            self._unlink(entry[0], entry[2])
+
+    def keys(self):
+        """Return the keys indexed, in order"""
+
+        order = self._order
+        return [order[n] for n in sorted(order)]
+
+    def get(self, key):
+        """Return the payload of key"""
+
+        return self._entries[key][1]
+
+    def clear(self):
+
+        self._entries.clear()
+        self._order.clear()
+        self._keys.clear()
+        self._tokens.clear()
+
+    def search(self, text):
+        """Return the keys matching every word of text, in order"""
+
+        matches = None
+        for word in sorted(get_tokens(text), key = len, reverse = True):
+            keys = set()
+            for token in self._find_tokens(word):
+                keys.update(self._keys[token])
+            if matches is None:
+                matches = keys
+            else:
+                matches &= keys
+            if not matches:
+                return []
+
+        if matches is None:
+            return []
+        order = self._order
+        return [order[n] for n in sorted(matches)]
+
+    def _find_tokens(self, word):
+
+        if len(word) < 3:
+            return [token for token in self._tokens.get(word, ())
+                if token.startswith(word)]
+
+        tokens = None
+        for gram in get_trigrams(word):
+            candidates = self._tokens.get(gram)
+            if not candidates:
+                return []
+            if tokens is None:
+                tokens = set(candidates)
+            else:
+                tokens &= candidates
+        return [token for token in tokens if word in token]
+
+    def _unlink(self, order, tokens):
+
+        for token in tokens:
+            keys = self._keys.get(token)
+            if keys is None:
+                continue
+            keys.discard(order)
+            if not keys:
+                del self._keys[token]
+                for gram in get_trigrams(token) | set([token[:1], token[:2]]):
+                    grams = self._tokens.get(gram)
+                    if grams is not None:
+                        grams.discard(token)
+                        if not grams:
+                            del self._tokens[gram]
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# stats.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Opt-in timing of the hot paths.
+
+Stages are timed with spans (with stats.span('name'): ...), events are
+counted with stats.count('name') and milestones of the launch are
+recorded with stats.mark('name'). Nothing is recorded unless the
+IMAGETHUMBNAIL_STATS environment variable is set: to 'log' to log the
+report of the launch when the activity closes, or to a file name (or
+an existing directory, for one file per launch) to write it as JSON.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+_logger = logging.getLogger('image-thumbnail')
+
+DESTINATION = os.environ.get('IMAGETHUMBNAIL_STATS', '')
+ENABLED = bool(DESTINATION)
+
+if DESTINATION == 'log':
+    _logger.setLevel(logging.INFO)
+
+_launch = time.time()
+_lock = threading.Lock()
+# name: [calls, total seconds, longest call]
+_spans = {}
+_counters = {}
+# name: seconds since launch
+_marks = {}
+
+
+class _Span(object):
+
+    def __init__(self, name):
+
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+
+        add_time(self.name, time.time() - self.start)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """Return a context manager timing the block it runs"""
+
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def add_time(name, seconds):
+
+    if not ENABLED:
+        return
+    with _lock:
+        record = _spans.get(name)
+        if record is None:
+            record = _spans[name] = [0, 0.0, 0.0]
+        record[0] += 1
+        record[1] += seconds
+        record[2] = max(record[2], seconds)
+
+
+def count(name, n = 1):
+
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def mark(name):
+    """Record when name first happened, in seconds since launch"""
+
+    if not ENABLED:
+        return
+    with _lock:
+        if name not in _marks:
+            _marks[name] = time.time() - _launch
+
+
+def get_report():
+
+    with _lock:
+        return {
+            'launch': time.strftime('%Y-%m-%dT%H:%M:%S',
+                time.localtime(_launch)),
+            'seconds': round(time.time() - _launch, 3),
+            'spans': dict((name, {'calls': calls,
+                'seconds': round(total, 4), 'longest': round(longest, 4)})
+                for name, (calls, total, longest) in _spans.items()),
+            'counters': dict(_counters),
+            'marks': dict((name, round(seconds, 3))
+                for name, seconds in _marks.items()),
+            }
+
+
+def dump():
+    """Hand the report of this launch to its destination"""
+
+    if not ENABLED:
+        return
+    report = get_report()
+
+    if DESTINATION == 'log':
+        _logger.info('Launch stats, %.3fs in all', report['seconds'])
+        for name, seconds in sorted(report['marks'].items(),
+            key = lambda item: item[1]):
+            _logger.info('  %-32s at %.3fs', name, seconds)
+        for name, record in sorted(report['spans'].items(),
+            key = lambda item: -item[1]['seconds']):
+            _logger.info('  %-32s %.3fs in %d calls, longest %.3fs', name,
+                record['seconds'], record['calls'], record['longest'])
+        for name, value in sorted(report['counters'].items()):
+            _logger.info('  %-32s %d', name, value)
+        return
+
+    filename = DESTINATION
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, 'stats-%s.json' %
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(_launch)))
+    try:
+        f = open(filename, 'w')
+        try:
+            json.dump(report, f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+    except IOError:
+        _logger.warning('Cannot write the launch stats to %s', filename)
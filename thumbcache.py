@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+# thumbcache.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Persistent on-disk thumbnail cache.
+
+Thumbnails are stored the way the freedesktop thumbnail specification
+lays out ~/.cache/thumbnails: one PNG per source file, named after the
+md5 of the file URI, carrying Thumb::URI, Thumb::MTime and Thumb::Size
+so a stale thumbnail can be recognised without touching the source.
+The cache lives in the activity data directory, one subdirectory per
+thumbnail size, and is kept under a byte budget by evicting the least
+recently used files.
+
+A file with no thumbnail of its own can borrow the one of a copy with
+the same content, so copies take a single thumbnail on disk.
+
+PixbufBudget does the same bookkeeping for the decoded thumbnails held
+in memory by the grids, counting a pixbuf shared by copies once.
+"""
+
+import os
+import errno
+import hashlib
+import logging
+from collections import OrderedDict
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from gi.repository import GdkPixbuf
+
+import stats
+from decoder import load_scaled
+
+_logger = logging.getLogger('image-thumbnail')
+
+# a 320x240 photo thumbnail takes 150 to 200 KB as a PNG, this holds
+# the thumbnails of some 1500 photos
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# share of the free space the cache takes at most by default
+FREE_SPACE_SHARE = 0.1
+
+
+def get_default_max_bytes(directory):
+    """Return DEFAULT_MAX_BYTES, or less where the free space is short"""
+
+    try:
+        st = os.statvfs(directory)
+    except OSError:
+        return DEFAULT_MAX_BYTES
+    # the thumbnails already there count as free
+    free = st.f_bavail * st.f_frsize + sum(os.path.getsize(
+        os.path.join(directory, name)) for name in os.listdir(directory)
+        if name.endswith('.png'))
+    return min(DEFAULT_MAX_BYTES, int(free * FREE_SPACE_SHARE))
+
+
+def get_uri(path):
+    """Return the file:// uri used to key a thumbnail"""
+
+    return 'file://' + quote(os.path.abspath(path))
+
+
+def get_thumbnail_name(path):
+    """Return the freedesktop file name of the thumbnail for path"""
+
+    uri = get_uri(path)
+    if not isinstance(uri, bytes):
+        uri = uri.encode('utf-8')
+    return hashlib.md5(uri).hexdigest() + '.png'
+
+
+class ThumbnailCache(object):
+
+    def __init__(self, root, width, height, max_bytes = None):
+
+        self.width = width
+        self.height = height
+        self.directory = os.path.join(root, '%dx%d' % (width, height))
+        self._bytes = None
+
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if max_bytes is None:
+            max_bytes = get_default_max_bytes(self.directory)
+        self.max_bytes = max_bytes
+
+    def get_thumbnail_path(self, path):
+
+        return os.path.join(self.directory, get_thumbnail_name(path))
+
+    def lookup(self, path, mtime, size):
+        """Return the cached pixbuf for path, or None when it is missing
+        or was made from a different version of the file"""
+
+        thumb_path = self.get_thumbnail_path(path)
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumb_path)
+        except Exception:
+            return None
+
+        if pixbuf.get_option('tEXt::Thumb::MTime') != str(int(mtime)) or \
+            pixbuf.get_option('tEXt::Thumb::Size') != str(size):
+            self._remove(thumb_path)
+            return None
+
+        # keep the access order for the LRU eviction
+        try:
+            os.utime(thumb_path, None)
+        except OSError:
+            pass
+        return pixbuf
+
+    def store(self, path, pixbuf, mtime, size):
+
+        thumb_path = self.get_thumbnail_path(path)
+        tmp_path = '%s.%d.tmp' % (thumb_path, os.getpid())
+        keys = ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime', 'tEXt::Thumb::Size',
+            'compression']
+        values = [get_uri(path), str(int(mtime)), str(size), '9']
+
+        try:
+            pixbuf.savev(tmp_path, 'png', keys, values)
+            os.rename(tmp_path, thumb_path)
+        except Exception:
+            _logger.debug('Cannot write thumbnail for %s', path)
+            self._remove(tmp_path)
+            return
+
+        if self._bytes is not None:
+            self._bytes += os.path.getsize(thumb_path)
+        self.evict()
+
+    def move(self, old, new):
+        """Keep the thumbnail of a file moved from old to new; its
+        Thumb::URI still names old, lookup goes by MTime and Size"""
+
+        try:
+            os.rename(self.get_thumbnail_path(old),
+                self.get_thumbnail_path(new))
+        except OSError:
+            pass
+
+    def invalidate(self, path):
+
+        self._remove(self.get_thumbnail_path(path))
+
+    def get_thumbnail(self, path, copies = ()):
+        """Return a thumbnail for path, decoding and storing it on a miss.
+
+        copies are (path, mtime, size) of files with the same content
+        when they had that mtime and size; the thumbnails of those that
+        still do are used before decoding path."""
+
+        st = os.stat(path)
+        with stats.span('thumbnail_lookup'):
+            pixbuf = self.lookup(path, st.st_mtime, st.st_size)
+            for copy, mtime, size in copies:
+                if pixbuf is not None:
+                    break
+                if copy == path:
+                    continue
+                try:
+                    copy_st = os.stat(copy)
+                except OSError:
+                    continue
+                if (copy_st.st_mtime, copy_st.st_size) == (mtime, size):
+                    pixbuf = self.lookup(copy, mtime, size)
+                    if pixbuf is not None:
+                        stats.count('thumbnail_cache_copies')
+        if pixbuf is not None:
+            stats.count('thumbnail_cache_hits')
+            return pixbuf
+
+        stats.count('thumbnail_cache_misses')
+        pixbuf = load_scaled(path, self.width, self.height)
+        with stats.span('thumbnail_store'):
+            self.store(path, pixbuf, st.st_mtime, st.st_size)
+        return pixbuf
+
+    def evict(self):
+        """Drop least recently used thumbnails until the cache fits
+        in max_bytes"""
+
+        if self._bytes is None:
+            self._bytes = sum(size for size, mtime, name in self._entries())
+        if self._bytes <= self.max_bytes:
+            return
+
+        entries = sorted(self._entries(), key = lambda entry: entry[1])
+        # go a bit below the budget so we don't evict on every store
+        target = self.max_bytes * 9 // 10
+        self._bytes = sum(entry[0] for entry in entries)
+        for size, mtime, name in entries:
+            if self._bytes <= target:
+                break
+            self._remove(os.path.join(self.directory, name))
+            self._bytes -= size
+
+    def _entries(self):
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.png'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            yield st.st_size, st.st_mtime, name
+
+    def _remove(self, path):
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class PixbufBudget(object):
+    """Keep count of the bytes of pixbufs held under some key, in least
+    recently used order, and pick the ones to drop past max_bytes.
+
+    A pixbuf added with a share, the content fingerprint of its file,
+    can be looked up by it while any key holds it, and its bytes are
+    counted once however many keys hold it."""
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key: (size, share)
+        self._sizes = OrderedDict()
+        # share: [pixbuf, keys holding it]
+        self._shared = {}
+
+    def add(self, key, pixbuf, share = None):
+
+        self.remove(key)
+        size = pixbuf.get_rowstride() * pixbuf.get_height()
+        if share is not None:
+            shared = self._shared.get(share)
+            if shared is None:
+                shared = self._shared[share] = [pixbuf, 0]
+                self.bytes += size
+            if shared[0] is pixbuf:
+                shared[1] += 1
+            else:
+                # a copy decoded on its own before the share was known
+                share = None
+        if share is None:
+            self.bytes += size
+        self._sizes[key] = (size, share)
+
+    def get_shared(self, share):
+        """Return the pixbuf held for share, or None"""
+
+        shared = self._shared.get(share)
+        if shared is None:
+            return None
+        return shared[0]
+
+    def touch(self, key):
+
+        record = self._sizes.pop(key, None)
+        if record is not None:
+            self._sizes[key] = record
+
+    def remove(self, key):
+
+        record = self._sizes.pop(key, None)
+        if record is None:
+            return
+        size, share = record
+        if share is not None:
+            shared = self._shared[share]
+            shared[1] -= 1
+            if shared[1]:
+                return
+            del self._shared[share]
+        self.bytes -= size
+
+    def evict(self, protected = ()):
+        """Forget the least recently used keys not in protected until
+        the pixbufs fit in max_bytes, and return them"""
+
+        evicted = []
+        if self.bytes <= self.max_bytes:
+            return evicted
+
+        for key in list(self._sizes.keys()):
+            if self.bytes <= self.max_bytes:
+                break
+            if key in protected:
+                continue
+            self.remove(key)
+            evicted.append(key)
+        return evicted
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# volumes.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Scanning of mounted volumes.
+
+Every volume has a scan index of its own, named after its volume id
+(the filesystem uuid when there is one), so the images of a stick
+inserted again are listed from its index right away and only what
+changed on it is rescanned. Each volume is rescanned on a thread of its
+own, for a limited time; a volume that takes longer is scanned further
+the next time, since the directories already indexed are not listed
+again unless they changed. The changes found are handed back to the
+main loop in batches.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+
+from gi.repository import GLib
+
+import stats
+from scanindex import ScanIndex
+
+_logger = logging.getLogger('image-thumbnail')
+
+# seconds between two batches of changes handed to the main loop
+BATCH_INTERVAL = 0.2
+
+
+def get_volume_index_path(directory, volume_id):
+
+    if not isinstance(volume_id, bytes):
+        volume_id = volume_id.encode('utf-8')
+    return os.path.join(directory, hashlib.md5(volume_id).hexdigest() + '.db')
+
+
+def open_volume_index(directory, mount, thumb_cache, fingerprints):
+    """Return the ScanIndex of a mounted volume, with its images moved
+    to where the volume is mounted now, along with their thumbnails in
+    thumb_cache and their fingerprints in the ScanIndex fingerprints"""
+
+    scan_index = ScanIndex(get_volume_index_path(directory,
+        mount['volume_id']))
+    for root in scan_index.get_roots():
+        if root != mount['mount_path']:
+            moves = scan_index.move_root(root, mount['mount_path'])
+            for old, new in moves:
+                thumb_cache.move(old, new)
+            fingerprints.move_fingerprints(moves)
+            stats.count('volume_files_moved', len(moves))
+    return scan_index
+
+
+class VolumeScan(object):
+    """Rescan a mounted volume into its scan index on a worker thread.
+
+    callback(added, removed, *user_data) gets the IndexEntry of the new
+    or changed images and the paths of the images that went away, on
+    the main loop. done_callback(scan, complete, *user_data) follows
+    the last batch; complete is False if the scan ran out of time.
+    """
+
+    def __init__(self, directory, mount, rules, budget, max_depth,
+        callback, done_callback, *user_data):
+
+        self.root = mount['mount_path']
+        self._filename = get_volume_index_path(directory, mount['volume_id'])
+        self._rules = rules
+        self._budget = budget
+        self._max_depth = max_depth
+        self._callback = callback
+        self._done_callback = done_callback
+        self._user_data = user_data
+
+        self._lock = threading.Lock()
+        self._added = []
+        self._removed = []
+        self._complete = None
+        self._idle_id = None
+        self._cancelled = False
+
+        self._thread = threading.Thread(target = self._run,
+            name = 'volume-scan-%s' % mount['label'])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        """Stop the scan; no callback is called after this"""
+
+        self._cancelled = True
+        with self._lock:
+            if self._idle_id is not None:
+                GLib.source_remove(self._idle_id)
+                self._idle_id = None
+
+    def _run(self):
+
+        start = time.time()
+        complete = True
+        try:
+            scan_index = ScanIndex(self._filename)
+            try:
+                batch_start = time.time()
+                for path, added, removed in scan_index.rescan(self.root,
+                    self._rules, max_depth = self._max_depth,
+                    commit_interval = 1):
+                    with self._lock:
+                        self._added.extend(added)
+                        self._removed.extend(removed)
+                    if time.time() - batch_start > BATCH_INTERVAL:
+                        self._schedule()
+                        batch_start = time.time()
+                    if self._cancelled or \
+                        time.time() - start > self._budget:
+                        complete = False
+                        break
+            finally:
+                scan_index.close()
+        except Exception:
+            _logger.warning('Cannot scan %s', self.root, exc_info = True)
+            complete = False
+
+        stats.add_time('volume_scan', time.time() - start)
+        if not complete:
+            stats.count('volume_scans_stopped')
+        with self._lock:
+            self._complete = complete
+        self._schedule()
+
+    def _schedule(self):
+
+        with self._lock:
+            if self._idle_id is None and not self._cancelled:
+                self._idle_id = GLib.idle_add(self._flush)
+
+    def _flush(self):
+
+        with self._lock:
+            self._idle_id = None
+            added = self._added
+            removed = self._removed
+            self._added = []
+            self._removed = []
+            complete = self._complete
+
+        if self._cancelled:
+            return False
+        if added or removed:
+            self._callback(added, removed, *self._user_data)
+        if complete is not None and not self._cancelled:
+            self._done_callback(self, complete, *self._user_data)
+        return False
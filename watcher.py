@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# watcher.py
+# Copyright (C) 2010 OLPC
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Watch scanned directories for changes.
+
+Gio directory monitors are not recursive, so every directory is watched
+on its own. Events are not acted upon one by one: the directories they
+touch are collected and handed to the callback together once the
+coalescing delay has passed.
+"""
+
+import logging
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+_logger = logging.getLogger('image-thumbnail')
+
+# milliseconds events are collected before the callback is run
+DELAY = 1000
+# inotify watches are a limited resource, stay well below the default
+MAX_MONITORS = 2048
+
+_EVENTS = set()
+for _name in ['CREATED', 'DELETED', 'CHANGES_DONE_HINT', 'MOVED',
+    'MOVED_IN', 'MOVED_OUT', 'RENAMED']:
+    if hasattr(Gio.FileMonitorEvent, _name):
+        _EVENTS.add(getattr(Gio.FileMonitorEvent, _name))
+
+
+class DirectoryWatcher(object):
+    """Call callback(directories, *user_data) with the directories in
+    which entries were created, deleted or changed"""
+
+    def __init__(self, callback, *user_data):
+
+        self._callback = callback
+        self._user_data = user_data
+        self._monitors = {}
+        self._dirty = set()
+        self._timeout_id = None
+        self._warned = False
+
+    def watch(self, directory):
+
+        if directory in self._monitors:
+            return
+        if len(self._monitors) >= MAX_MONITORS:
+            if not self._warned:
+                _logger.warning('Not watching more than %d directories',
+                    MAX_MONITORS)
+                self._warned = True
+            return
+
+        try:
+            monitor = Gio.File.new_for_path(directory).monitor_directory(
+                Gio.FileMonitorFlags.NONE, None)
+        except GLib.GError:
+            _logger.debug('Cannot watch %s', directory)
+            return
+        monitor.connect('changed', self._changed_cb, directory)
+        self._monitors[directory] = monitor
+
+    def unwatch(self, directory):
+
+        monitor = self._monitors.pop(directory, None)
+        if monitor is not None:
+            monitor.cancel()
+
+    def stop(self):
+
+        for monitor in self._monitors.values():
+            monitor.cancel()
+        self._monitors.clear()
+        self._dirty.clear()
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _changed_cb(self, monitor, changed_file, other_file, event_type,
+        directory):
+
+        if event_type not in _EVENTS:
+            return
+        if event_type == Gio.FileMonitorEvent.DELETED and \
+            changed_file.get_path() == directory:
+            self.unwatch(directory)
+
+        self._dirty.add(directory)
+        if self._timeout_id is None:
+            self._timeout_id = GLib.timeout_add(DELAY, self._flush_cb)
+
+    def _flush_cb(self):
+
+        self._timeout_id = None
+        directories = sorted(self._dirty)
+        self._dirty.clear()
+        self._callback(directories, *self._user_data)
+        return False